@@ -1,94 +1,145 @@
 #!/usr/bin/env python3
 
-import boto3 
+import boto3
+import botocore
 import json
+import time
+import concurrent.futures
 from datetime import datetime, timedelta, timezone
 import argparse
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-def delete_non_current_versions(endpoint:str, bucket_name:str, prefix:str='', days_threshold:int=30, simulate:bool=False):
-   
+# Max number of versions accepted by a single DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+
+def get_retention(s3client, bucket_name:str, entry:dict):
+    try:
+        retention = s3client.get_object_retention(Bucket=bucket_name,Key=entry['Key'],VersionId=entry['VersionId'])
+        return retention['Retention']['RetainUntilDate']
+    except Exception:
+        return None
+
+def describe(bucket_name:str, entry:dict, delete_marker:bool):
+    last_modified = entry['LastModified'].replace(tzinfo=timezone.utc)
+    if delete_marker:
+        return f"s3://{bucket_name}/{entry['Key']} (Version ID: {entry['VersionId']}) Modified Time: {last_modified} Delete Marker: True"
+    return f"s3://{bucket_name}/{entry['Key']} (Version ID: {entry['VersionId']}) Size: {entry['Size']} Modified Time: {last_modified} Delete Marker: False"
+
+def delete_batch(s3client, bucket_name:str, batch:list):
+    try:
+        response = s3client.delete_objects(Bucket=bucket_name, Delete={'Objects': [{'Key': entry['Key'], 'VersionId': entry['VersionId']} for entry, delete_marker in batch], 'Quiet': True})
+        # Quiet mode only reports the versions which could not be deleted
+        errors = {(error['Key'], error['VersionId']): f"{error['Code']} {error['Message']}" for error in response.get('Errors', [])}
+    except Exception as err:
+        errors = {(entry['Key'], entry['VersionId']): err for entry, delete_marker in batch}
+    return errors
+
+def report_batch(bucket_name:str, batch:list, errors:dict, stats:dict):
+    for entry, delete_marker in batch:
+        err = errors.get((entry['Key'], entry['VersionId']))
+        if err is None:
+            stats['deleted'] += 1
+            print(f"Deleted: {describe(bucket_name, entry, delete_marker)}")
+            continue
+        stats['failed'] += 1
+        last_modified = entry['LastModified'].replace(tzinfo=timezone.utc)
+        if delete_marker:
+            print(f"Failed to delete: s3://{bucket_name}/{entry['Key']} (Version ID: {entry['VersionId']}) Modified Time: {last_modified} Delete Marker: True Error: {err}")
+        else:
+            print(f"Could Not Delete: s3://{bucket_name}/{entry['Key']} (Version ID: {entry['VersionId']}) Modified Time: {last_modified} Delete Marker: False Error: {err}")
+
+def split_last_key(page:dict, pending_versions:list, pending_markers:list):
+    versions = pending_versions + page.get('Versions', [])
+    markers = pending_markers + page.get('DeleteMarkers', [])
+    if not page.get('IsTruncated'):
+        return versions, markers, [], []
+    # The versions of the last key may go on in the next page: keep them until the whole key is known,
+    # so that its delete markers are never removed before a version of the same key is found in retention
+    last_key = max(entries[-1]['Key'] for entries in (versions, markers) if entries)
+    return ([entry for entry in versions if entry['Key'] != last_key], [entry for entry in markers if entry['Key'] != last_key],
+            [entry for entry in versions if entry['Key'] == last_key], [entry for entry in markers if entry['Key'] == last_key])
+
+def delete_non_current_versions(endpoint:str, bucket_name:str, prefix:str='', days_threshold:int=30, simulate:bool=False, max_workers:int=10):
+
     current_time = datetime.now(timezone.utc)
-    skipped = list()
+    start_time = time.monotonic()
+    skipped = set()
+    stats = {'listed': 0, 'deleted': 0, 'skipped': 0, 'failed': 0}
 
-    s3client = boto3.client('s3', endpoint_url=endpoint, verify=False)
+    s3client = boto3.client('s3', endpoint_url=endpoint, verify=False, config=botocore.config.Config(max_pool_connections=max_workers))
     paginator = s3client.get_paginator('list_object_versions')
     list_params = {
-       'Bucket': bucket_name
+       'Bucket': bucket_name,
+       'Prefix': prefix
     }
-    for page in paginator.paginate(**list_params):
-        versions = s3client.list_object_versions(Bucket=bucket_name)
-        for version in page.get('Versions', []):
-            key = version['Key']
-            version_id = version['VersionId']
-            is_latest = version['IsLatest']
-            size = version['Size']
-            last_modified = version['LastModified'].replace(tzinfo=timezone.utc)
+    batch = []
+    deletes = {}
+    pending_versions = []
+    pending_markers = []
+
+    def flush(wait:bool):
+        for future in [future for future in deletes if wait or future.done()]:
+            report_batch(bucket_name, deletes.pop(future), future.result(), stats)
+
+    def queue_delete(entry:dict, delete_marker:bool):
+        nonlocal batch
+        if simulate:
+            stats['deleted'] += 1
+            print(f"SIMULATE Deleted: {describe(bucket_name, entry, delete_marker)}")
+            return
+        batch.append((entry, delete_marker))
+        if len(batch) == DELETE_BATCH_SIZE:
+            # Don't let the deletes pile up in memory when the listing is faster
+            if len(deletes) >= max_workers:
+                concurrent.futures.wait(deletes, return_when=concurrent.futures.FIRST_COMPLETED)
+            deletes[executor.submit(delete_batch, s3client, bucket_name, batch)] = batch
+            batch = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        for page in paginator.paginate(**list_params):
+            stats['listed'] += len(page.get('Versions', [])) + len(page.get('DeleteMarkers', []))
+            versions, markers, pending_versions, pending_markers = split_last_key(page, pending_versions, pending_markers)
 
             # Skip the current version as we only want to delete non-current versions
-            if is_latest:
-                continue
-            if not key.startswith(prefix):
-                continue
-
-            age = current_time - last_modified
-            if age > timedelta(days=days_threshold):
-                try:
-                        retention = s3client.get_object_retention(Bucket=bucket_name,Key=key,VersionId=version_id)
-                        retention_period = retention['Retention']['RetainUntilDate']
-                except:
-                        retention_period = None
+            versions = [version for version in versions if not version['IsLatest'] and version['Key'].startswith(prefix)
+                        and current_time - version['LastModified'].replace(tzinfo=timezone.utc) > timedelta(days=days_threshold)]
+            markers = [marker for marker in markers if marker['Key'].startswith(prefix)
+                       and current_time - marker['LastModified'].replace(tzinfo=timezone.utc) > timedelta(days=days_threshold)]
+            retentions = list(executor.map(lambda entry: get_retention(s3client, bucket_name, entry), versions + markers))
 
+            for version, retention_period in zip(versions, retentions):
                 if retention_period:
-                        days_until_retnetion = current_time - retention_period
-                        if days_until_retnetion.days < 0:
-                            print(f"Skipping: s3://{bucket_name}/{key} (Version ID: {version['VersionId']}) Retention: {retention_period}")
-                            skipped.append(key)
-                            continue
-                try:
-                    if not simulate:
-                        s3client.delete_object(Bucket=bucket_name, Key=key, VersionId=version_id)
-                        print(f"Deleted: s3://{bucket_name}/{key} (Version ID: {version['VersionId']}) Size: {size} Modified Time: {last_modified} Delete Marker: False")
-                    else:
-                        print(f"SIMULATE Deleted: s3://{bucket_name}/{key} (Version ID: {version['VersionId']}) Size: {size} Modified Time: {last_modified} Delete Marker: False")
-                except Exception as err:
-                    print(f"Could Not Delete: s3://{bucket_name}/{key} (Version ID: {version['VersionId']}) Modified Time: {last_modified} Delete Marker: False Error: {err}")
-    
-    for page in paginator.paginate(**list_params):  
-        for version in versions.get('DeleteMarkers', []):
-            key = version['Key']
-            version_id = version['VersionId']
-            last_modified = version['LastModified'].replace(tzinfo=timezone.utc)
-            age = current_time - last_modified
-
-            if not key.startswith(prefix):
-                continue
-            
-            if age > timedelta(days=days_threshold):
-                try:
-                    retention = s3client.get_object_retention(Bucket=bucket_name,Key=key,VersionId=version_id)
-                    retention_period = retention['Retention']['RetainUntilDate']
-                except:
-                    retention_period = None
-                
+                    days_until_retnetion = current_time - retention_period
+                    if days_until_retnetion.days < 0:
+                        print(f"Skipping: s3://{bucket_name}/{version['Key']} (Version ID: {version['VersionId']}) Retention: {retention_period}")
+                        skipped.add(version['Key'])
+                        stats['skipped'] += 1
+                        continue
+                queue_delete(version, False)
+
+            for marker, retention_period in zip(markers, retentions[len(versions):]):
                 if retention_period:
                     days_until_retnetion = current_time - retention_period
                     if days_until_retnetion.days < 0:
-                        print(f"Skipping: s3://{bucket_name}/{key} (Version ID: {version['VersionId']}) Retention: {retention_period}")
+                        print(f"Skipping: s3://{bucket_name}/{marker['Key']} (Version ID: {marker['VersionId']}) Retention: {retention_period}")
+                        stats['skipped'] += 1
                         continue
-                
-                if key in skipped:
+
+                if marker['Key'] in skipped:
                     continue
-                try:
-                    if not simulate:
-                        s3client.delete_object(Bucket=bucket_name, Key=key, VersionId=version['VersionId'])
-                        print(f"Deleted: s3://{bucket_name}/{key} (Version ID: {version_id}) Modified Time: {last_modified} Delete Marker: True")
-                    else:
-                        print(f"SIMULATE Deleted: s3://{bucket_name}/{key} (Version ID: {version_id}) Modified Time: {last_modified} Delete Marker: True")
+                queue_delete(marker, True)
+
+            flush(wait=False)
+
+        if batch:
+            deletes[executor.submit(delete_batch, s3client, bucket_name, batch)] = batch
+        flush(wait=True)
 
-                except Exception as err:
-                    print(f"Failed to delete: s3://{bucket_name}/{key} (Version ID: {version_id}) Modified Time: {last_modified} Delete Marker: True Error: {err}")
+    elapsed = time.monotonic() - start_time
+    print(f"Summary: {stats['listed']} versions listed, {stats['deleted']} {'simulated ' if simulate else ''}deleted, {stats['skipped']} skipped, "
+          f"{stats['failed']} failed in {elapsed:.1f}s ({stats['listed'] / elapsed if elapsed else 0:.1f} versions/s listed, "
+          f"{stats['deleted'] / elapsed if elapsed else 0:.1f} versions/s deleted)")
 
 
 def main():
@@ -99,19 +150,20 @@ def main():
     parser.add_argument('-e', '--endpoint', help='s3 endpoint url', required=True)
     parser.add_argument('-d', '--days', help='delete objects version older than', required=True, type=int)
     parser.add_argument('-s', '--simulate', help='simulate only', required=False, default=False,action='store_true')
+    parser.add_argument('-w', '--max-workers', help='max number of concurrent retention lookups and delete requests', required=False, default=10, type=int)
     args = parser.parse_args()
-    
-    bucket_name = args.bucket 
+
+    bucket_name = args.bucket
     days_threshold = args.days
     endpoint = args.endpoint
     prefix = args.prefix
     simulate = args.simulate
+    max_workers = args.max_workers
 
     try:
-        delete_non_current_versions(endpoint=endpoint, bucket_name=bucket_name, prefix=prefix, days_threshold=days_threshold, simulate=simulate)
+        delete_non_current_versions(endpoint=endpoint, bucket_name=bucket_name, prefix=prefix, days_threshold=days_threshold, simulate=simulate, max_workers=max_workers)
     except Exception as err:
-        print(f"Error: {err}")    
+        print(f"Error: {err}")
 
 if __name__ == "__main__":
     main()
-
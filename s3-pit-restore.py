@@ -29,18 +29,148 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import shutup;shutup.please()
-import os, sys, time, signal, argparse, boto3, botocore, \
-        unittest, concurrent.futures, shutil, uuid, time
-from datetime import datetime, timezone
-from dateutil.parser import parse
-from s3transfer.manager import TransferConfig
+import os, sys, time, signal, argparse, \
+        unittest, concurrent.futures, shutil, uuid, time, queue, threading, sqlite3, \
+        json, collections, random, resource, gzip, csv, urllib.parse, tempfile, zlib, tarfile, io, fcntl, types, \
+        hashlib, base64, mmap
+from datetime import datetime, timezone, timedelta
+
+# boto3 and botocore take most of the startup time, they are imported by import_boto3 once a restore needs them
+boto3 = None
+botocore = None
+Config = None
+TransferConfig = None
+create_transfer_manager = None
+# Only the async engine runs an event loop, asyncio is imported by do_restore_async
+asyncio = None
 
 args = None
 executor = None
 transfer = None
 futures = {}
+unbounded_futures = set()
 client = None
+inflight = None
+print_lock = threading.Lock()
+index = None
+index_lock = threading.Lock()
+checkpoint = None
+checkpoint_lock = threading.RLock()
+checkpoint_pages = {}
+done_objs = set()
+dest_objs = None
+async_client = None
+async_inflight = None
+async_tasks = set()
+glacier_state = {}
+glacier_state_file = None
+glacier_lock = threading.Lock()
+glacier_pending = []
+interrupted = threading.Event()
+concurrency = {}
+concurrency_cond = threading.Condition()
+prefix_backoff = {}
+plan = None
+plan_lock = threading.Lock()
+verify_file = None
+verify_pool = None
+shard_bounds = None
+archive = None
+archive_part = 0
+archive_cond = threading.Condition()
+archive_write_lock = threading.Lock()
+archive_buffer = {}
+archive_seq = 0
+archive_next = 0
+dedup = collections.OrderedDict()
+dedup_lock = threading.Lock()
+metrics = {"Phases": collections.defaultdict(float), "Operations": {}, "Listed": 0, "ListingDone": False}
+metrics_lock = threading.Lock()
+progress_stop = threading.Event()
+work_queue = None
+
+# Transfers submitted to the executor per worker, so that a worker never waits for the next one
+INFLIGHT_PER_WORKER = 2
+# Error codes of the requests throttled by S3, retried with a jittered backoff instead of failing the object
+THROTTLE_ERROR_CODES = ("SlowDown", "503", "Throttling", "ThrottlingException", "RequestLimitExceeded", "TooManyRequests")
+# Bounds in seconds of the backoff of the throttled requests, which doubles at each retry
+THROTTLE_BASE_DELAY = 0.5
+THROTTLE_MAX_DELAY = 30
+# The adaptive concurrency stops growing while the request latency is over this factor of the best one seen
+LATENCY_HEALTHY_FACTOR = 2
+# Weight of the last request in the moving average of the latency
+LATENCY_SMOOTHING = 0.1
+# Versions downloaded ahead of the next one to write in the archive, per worker
+ARCHIVE_REORDER_PER_WORKER = 8
+# Upper bounds in seconds of the buckets of the request latency histograms, the last bucket holds the slower ones
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Seconds between two writes of the metrics file when no progress line is asked
+METRICS_INTERVAL = 10
+# Synthetic bucket of the benchmarks: keys spread over folders, each with up to 6 versions over a year, some of them
+# delete markers. The point in time restored falls in the last months, and the local restore lists fewer keys
+BENCHMARK_BUCKET = "benchmark-bucket"
+BENCHMARK_FOLDERS = 16
+BENCHMARK_START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+BENCHMARK_HISTORY_SECONDS = 365 * 24 * 3600
+BENCHMARK_DELETE_MARKERS = 0.3
+BENCHMARK_TIMESTAMP = "2020-10-01T00:00:00+00:00"
+BENCHMARK_LOCAL_RATIO = 100
+# Additional checksums verified by --verify checksum, the first one a version has is used
+VERIFY_CHECKSUMS = (("ChecksumSHA256", "sha256"), ("ChecksumSHA1", "sha1"), ("ChecksumCRC32C", "crc32c"), ("ChecksumCRC32", "crc32"))
+# Full object checksums of S3 compared between a version and its copy in a bucket when their ETags can't be
+REMOTE_CHECKSUMS = ("ChecksumCRC64NVME", "ChecksumCRC32C", "ChecksumCRC32", "ChecksumSHA256", "ChecksumSHA1")
+# Checksum of the copies made with --verify, CRC64NVME checksums are full object ones even for multipart copies
+VERIFY_COPY_CHECKSUM = "CRC64NVME"
+# Options sizing the client and the workers, only given to a RestoreSession and not to each of its restores
+SESSION_OPTIONS = ("endpoint_url", "engine", "max_workers", "max_concurrency", "multipart_threshold", "multipart_chunksize", "max_bandwidth", "listing_workers")
+# Contents remembered by the deduplication, the oldest restored ones are forgotten past it
+DEDUP_MAX_CONTENTS = 1000000
+# ioctl cloning a file on the filesystems supporting reflinks (Linux FICLONE)
+FICLONE = 0x40049409
+# Max number of keys accepted by a single DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+# Keys to delete kept in memory, beyond it they are moved to a temporary database on disk
+DELETE_SPILL_THRESHOLD = 100000
+# How many levels of common prefixes are explored when splitting the listing in shards
+SHARD_DISCOVERY_DEPTH = 3
+# Split points used for key ranges when the keyspace has no common prefixes to split on
+KEY_RANGE_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+# Storage classes which have to be restored before being downloaded
+GLACIER_STORAGE_CLASSES = ("GLACIER", "DEEP_ARCHIVE")
+# Days a restored archive copy is kept available
+GLACIER_RESTORE_DAYS = 3
+# Seconds between the polls of the archived versions still being restored, doubled after each poll
+GLACIER_POLL_DELAY = 60
+GLACIER_MAX_POLL_DELAY = 3600
+# Versions per page when the listing is read back from the local version index
+INDEX_PAGE_SIZE = 1000
+# Inventory rows inserted in the version index at once
+INVENTORY_BATCH_SIZE = 10000
+# Columns of the ORC and Parquet inventories, by their name in the CSV file schema
+INVENTORY_COLUMNS = {"Bucket": "bucket", "Key": "key", "VersionId": "version_id", "IsDeleteMarker": "is_delete_marker", "Size": "size",
+                     "LastModifiedDate": "last_modified_date", "ETag": "e_tag", "StorageClass": "storage_class"}
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    bucket TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    generation INTEGER NOT NULL,
+    PRIMARY KEY (bucket, prefix)
+);
+CREATE TABLE IF NOT EXISTS versions (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    version_id TEXT NOT NULL,
+    is_delete_marker INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    last_modified TEXT NOT NULL,
+    size INTEGER,
+    storage_class TEXT,
+    etag TEXT,
+    generation INTEGER NOT NULL,
+    PRIMARY KEY (bucket, key, version_id)
+);
+CREATE INDEX IF NOT EXISTS versions_order ON versions (bucket, is_delete_marker, key, position);
+"""
 
 class TestS3PitRestore(unittest.TestCase):
 
@@ -149,7 +279,7 @@ class TestS3PitRestore(unittest.TestCase):
         self.remove_tree(path)
 
         args.from_timestamp = str(time_before)
-        args.timestamp = str(time_after)
+        args.timestamp = [str(time_after)]
         args.prefix = os.path.basename(os.path.normpath(path))
         do_restore()
         print("Restoring and checking ...")
@@ -173,89 +303,1500 @@ class TestS3PitRestore(unittest.TestCase):
 
         print("deleting ...")
         self.delete_directory(s3, path)
-        args.timestamp = str(time_before)
+        args.timestamp = [str(time_before)]
         args.prefix = os.path.basename(os.path.normpath(path))
         do_restore()
         print("Restoring and checking for dmarker_restore test")
         self.assertTrue(self.check_tree(path, content))
 
+class TestPitResolver(unittest.TestCase):
+    # Runs offline on synthetic listings, no bucket needed
+
+    def generate_pages(self, rng, keys, page_size):
+        # Entries are sorted like list_object_versions: by key and then newest first, versions and delete
+        # markers of a page being returned in two separate lists
+        base = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        entries = []
+        for key in sorted(rng.sample(range(100000), keys)):
+            dates = sorted(rng.sample(range(1000), rng.randint(1, 6)), reverse=True)
+            for n, date in enumerate(dates):
+                entries.append((rng.random() < 0.4, Version("key%05d" % key, "v%d" % n, base + timedelta(seconds=date), 1, "STANDARD", "etag")))
+        pages = []
+        for start in range(0, len(entries), page_size):
+            chunk = entries[start:start + page_size]
+            pages.append({"Versions": [obj for is_dmarker, obj in chunk if not is_dmarker], "DeleteMarkers": [obj for is_dmarker, obj in chunk if is_dmarker]})
+        return base, pages
+
+    def reference_resolve(self, pages, pit_start_date, pit_end_date):
+        # The list based merge the resolver had before the deques, kept as the reference
+        restored = []
+        deleted = {}
+        last_obj = {"Key": ""}
+        previous_deletemarkers = []
+        for page in pages:
+            deletemarkers = previous_deletemarkers + list(page["DeleteMarkers"])
+            previous_deletemarkers = []
+            dmarker = {"Key": ""}
+            for obj in page["Versions"]:
+                if last_obj["Key"] == obj["Key"]:
+                    continue
+                if obj["LastModified"] > pit_end_date or obj["LastModified"] < pit_start_date:
+                    if pit_start_date == datetime.fromtimestamp(0, timezone.utc):
+                        deleted[obj["Key"]] = obj
+                    continue
+                while deletemarkers and (dmarker["Key"] < obj["Key"] or (dmarker["Key"] == obj["Key"] and dmarker["LastModified"] > pit_end_date)):
+                    dmarker = deletemarkers.pop(0)
+                if dmarker["Key"] == obj["Key"] and dmarker["LastModified"] > obj["LastModified"] and dmarker["LastModified"] <= pit_end_date:
+                    last_obj = dmarker
+                    continue
+                last_obj = obj
+                restored.append((obj["Key"], obj["VersionId"]))
+            previous_deletemarkers.append(dmarker)
+            previous_deletemarkers += deletemarkers
+        return restored, sorted(deleted)
+
+    def resolve(self, pages, pit_start_date, pit_end_date):
+        pits = [new_pit(pit_end_date, snapshot_label(pit_end_date))]
+        obj_needs_be_deleted = DeleteSet()
+        restored = []
+        for page in pages:
+            restored += [(obj["Key"], obj["VersionId"]) for obj in resolve_page(pits, page, pit_start_date, obj_needs_be_deleted)]
+        return restored, sorted(obj["Key"] for obj in obj_needs_be_deleted.values())
+
+    def test_resolver_equivalence(self):
+        rng = random.Random(0)
+        for n in range(200):
+            base, pages = self.generate_pages(rng, rng.randint(1, 60), rng.randint(1, 12))
+            pit_end_date = base + timedelta(seconds=rng.randint(0, 1000))
+            pit_start_date = rng.choice([datetime.fromtimestamp(0, timezone.utc), base + timedelta(seconds=rng.randint(0, 500))])
+            self.assertEqual(self.resolve(pages, pit_start_date, pit_end_date), self.reference_resolve(pages, pit_start_date, pit_end_date))
+
+    def test_resolver_benchmark(self):
+        # A mass deletion: 1M keys, each one deleted by a delete marker newer than its only version
+        markers = 1000000
+        page_size = 1000
+        pit_end_date = datetime(2020, 1, 2, tzinfo=timezone.utc)
+        version_date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        dmarker_date = datetime(2020, 1, 1, 12, tzinfo=timezone.utc)
+
+        def pages():
+            for start in range(0, markers, page_size // 2):
+                keys = ["key%07d" % key for key in range(start, min(start + page_size // 2, markers))]
+                yield {"Versions": [Version(key, "v", version_date) for key in keys], "DeleteMarkers": [Version(key, "d", dmarker_date) for key in keys]}
+
+        pits = [new_pit(pit_end_date, snapshot_label(pit_end_date))]
+        start = time.monotonic()
+        restored = sum(1 for page in pages() for obj in resolve_page(pits, page, version_date, None))
+        elapsed = time.monotonic() - start
+        print("Resolved %d delete markers in %.2f seconds (%.0f markers/s)" % (markers, elapsed, markers / elapsed))
+        self.assertEqual(restored, 0)
+
+class TestInventory(unittest.TestCase):
+    # Runs offline on a CSV inventory written in a temporary directory, no bucket needed
+
+    def setUp(self):
+        global args
+        self.saved = (args, index)
+        args = make_args({"bucket": "inventory-bucket", "prefix": "data/"})
+        open_index("")
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        global args, index
+        index.close()
+        args, index = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def write_inventory(self, rows):
+        # Laid out like an inventory synced from its destination bucket
+        os.makedirs(os.path.join(self.tmpdir, "data"))
+        os.makedirs(os.path.join(self.tmpdir, "2020-01-10T00-00Z"))
+        with gzip.open(os.path.join(self.tmpdir, "data", "part0.csv.gz"), "wt", newline="") as data_file:
+            csv.writer(data_file).writerows(rows)
+        manifest_path = os.path.join(self.tmpdir, "2020-01-10T00-00Z", "manifest.json")
+        with open(manifest_path, "w") as manifest_file:
+            json.dump({"sourceBucket": args.bucket, "fileFormat": "CSV",
+                       "fileSchema": "Bucket, Key, VersionId, IsLatest, IsDeleteMarker, Size, LastModifiedDate, ETag, StorageClass",
+                       "files": [{"key": "inventory/inventory-bucket/all-versions/data/part0.csv.gz"}]}, manifest_file)
+        return manifest_path
+
+    def test_inventory_restore(self):
+        bucket = args.bucket
+        manifest_path = self.write_inventory([
+            # Rows are in no particular order, like in the inventory files
+            [bucket, "data/b+file", "b2", "true", "false", "20", "2020-01-05T00:00:00.000Z", "etagb2", "STANDARD"],
+            [bucket, "data/a", "a1", "false", "false", "10", "2020-01-01T00:00:00.000Z", "etaga1", "STANDARD"],
+            [bucket, "data/b+file", "b1", "false", "false", "10", "2020-01-01T00:00:00.000Z", "etagb1", "GLACIER"],
+            [bucket, "data/a", "a2", "true", "true", "", "2020-01-03T00:00:00.000Z", "", ""],
+            [bucket, "data/c%2Bd", "", "true", "false", "5", "2019-12-01T00:00:00.000Z", "etagc", "STANDARD"],
+            [bucket, "other/e", "e1", "true", "false", "5", "2019-12-01T00:00:00.000Z", "etage", "STANDARD"],
+        ])
+        load_inventory(manifest_path, next_index_generation())
+
+        def restored(pit_end_date):
+            pits = [new_pit(pit_end_date, snapshot_label(pit_end_date))]
+            return [(obj["Key"], obj["VersionId"], obj["Size"], obj["StorageClass"], obj["ETag"])
+                    for page in index_pages({"Prefix": args.prefix}) for obj in resolve_page(pits, page, datetime.fromtimestamp(0, timezone.utc), None)]
+
+        self.assertEqual(restored(datetime(2020, 1, 2, tzinfo=timezone.utc)), [
+            ("data/a", "a1", 10, "STANDARD", '"etaga1"'),
+            ("data/b file", "b1", 10, "GLACIER", '"etagb1"'),
+            ("data/c+d", "null", 5, "STANDARD", '"etagc"'),
+        ])
+        self.assertEqual(restored(datetime(2020, 1, 6, tzinfo=timezone.utc)), [
+            ("data/b file", "b2", 20, "STANDARD", '"etagb2"'),
+            ("data/c+d", "null", 5, "STANDARD", '"etagc"'),
+        ])
+
+    def test_index_shards(self):
+        # The shards of a journal read back from the index give each version once, like their listings
+        bucket = args.bucket
+        load_inventory(self.write_inventory([[bucket, key, "v", "true", "false", "1", "2020-01-01T00:00:00.000Z", "etag", "STANDARD"]
+                                             for key in ("data/a", "data/b", "data/dir/c", "data/dir/d", "data/e")]), next_index_generation())
+        shards = [{"Prefix": "data/", "Delimiter": "/"}, {"Prefix": "data/dir/", "EndKey": "data/dir/c"}, {"Prefix": "data/dir/", "KeyMarker": "data/dir/c"}]
+        keys = [obj["Key"] for shard in shards for page in index_pages(shard) for obj in page["Versions"]]
+        self.assertEqual(sorted(keys), ["data/a", "data/b", "data/dir/c", "data/dir/d", "data/e"])
+
+class TestShards(unittest.TestCase):
+    # Runs offline, no bucket needed
+
+    def setUp(self):
+        global args
+        self.saved = (args, shard_bounds, client)
+        args = make_args({})
+
+    def tearDown(self):
+        global args, shard_bounds, client
+        args, shard_bounds, client = self.saved
+
+    def owners(self, keys, bounds):
+        global shard_bounds
+        shard_bounds = bounds
+        owners = collections.Counter()
+        for shard_index in range(4):
+            args.shard = (shard_index, 4)
+            owners.update(key for key in keys if owns_key(key))
+        return owners
+
+    def test_disjoint_shards(self):
+        keys = ["folder%d/file%d" % (n % 7, n) for n in range(1000)]
+        for bounds in (None, ["folder1", "folder3/file5", "folder5"]):
+            self.assertEqual(self.owners(keys, bounds), collections.Counter(keys))
+
+    def test_discover_shards(self):
+        # Against StubS3: one request per probed prefix, whatever the number of versions under it
+        global client
+        client = StubS3(20000)
+        requests = []
+        client.meta.events.register("before-call.s3.ListObjectVersions", lambda **kwargs: requests.append(kwargs))
+        args.bucket, args.prefix, args.listing_workers = BENCHMARK_BUCKET, "", 32
+        with concurrent.futures.ThreadPoolExecutor(4) as listing_executor:
+            shards = discover_shards(listing_executor)
+        self.assertEqual(shards, [{"Prefix": "folder%02d/" % n} for n in range(BENCHMARK_FOLDERS)])
+        self.assertEqual(len(requests), 1 + BENCHMARK_FOLDERS)
+        # A flat keyspace bigger than a page is split by key ranges after a single request
+        del requests[:]
+        args.prefix = "folder00/"
+        with concurrent.futures.ThreadPoolExecutor(4) as listing_executor:
+            shards = discover_shards(listing_executor)
+        self.assertEqual(shards, split_key_range("folder00/"))
+        self.assertEqual(len(requests), 1)
+
+    def test_restrict_shard(self):
+        self.assertEqual(restrict_shard({"Prefix": "b/"}, "a", "c"), {"Prefix": "b/", "KeyMarker": "a", "EndKey": "c"})
+        self.assertEqual(restrict_shard({"Prefix": "b/", "KeyMarker": "b/5"}, "a", None), {"Prefix": "b/", "KeyMarker": "b/5"})
+        self.assertIsNone(restrict_shard({"Prefix": "b/"}, "c", None))
+        self.assertIsNone(restrict_shard({"Prefix": "b/"}, None, "a"))
+        self.assertIsNone(restrict_shard({"Prefix": "", "KeyMarker": "m"}, None, "f"))
+
+class StubEvents:
+    # The few hooks of the botocore event system used by the restore, handlers being registered on an event prefix
+
+    def __init__(self):
+        self.handlers = []
+
+    def register(self, event_name, handler, unique_id=None):
+        self.handlers.append((event_name, handler))
+
+    register_first = register
+    register_last = register
+
+    def unregister(self, event_name, handler=None, unique_id=None):
+        self.handlers = [(name, registered) for name, registered in self.handlers if (name, registered) != (event_name, handler)]
+
+    def emit(self, event_name, **kwargs):
+        for name, handler in self.handlers:
+            if event_name == name or event_name.startswith(name + "."):
+                handler(event_name=event_name, **kwargs)
+
+class StubBody:
+
+    def __init__(self, size):
+        self.size = size
+        self.position = 0
+
+    def iter_chunks(self, chunk_size=1024 ** 2):
+        for start in range(0, self.size, chunk_size):
+            yield b"\0" * min(chunk_size, self.size - start)
+
+    def read(self, size=-1):
+        # Archives read the bodies like files
+        size = self.size - self.position if size is None or size < 0 else min(size, self.size - self.position)
+        self.position += size
+        return b"\0" * size
+
+class StubS3:
+    # In-process stand-in of the S3 client for the benchmarks. The versioned bucket is synthetic: the history of
+    # each key is generated from its number whenever it's listed or read, so millions of versions take no memory
+
+    def __init__(self, keys, max_size=None, seed=0):
+        self.keys = keys
+        self.max_size = max_size
+        self.seed = seed
+        self.meta = types.SimpleNamespace(events=StubEvents(), region_name="us-east-1", config=Config())
+        self.listed = 0
+        self.lock = threading.Lock()
+
+    def key(self, number):
+        # Keys sort like their numbers, spread over a few folders for the listing shards
+        return "folder%02d/file%08d" % (number * BENCHMARK_FOLDERS // self.keys, number)
+
+    def first_key(self, key, after):
+        # Number of the first key from the given one, or after it
+        low, high = 0, self.keys
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key or after and self.key(middle) == key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def history(self, number):
+        # Newest first like the listing, with dense delete markers and mixed sizes and storage classes
+        rng = random.Random(self.seed * 1000003 + number)
+        key = self.key(number)
+        dates = sorted(rng.sample(range(BENCHMARK_HISTORY_SECONDS), rng.randint(1, 6)), reverse=True)
+        entries = []
+        for n, date in enumerate(dates):
+            entry = {"Key": key, "VersionId": "%d.%d" % (number, n), "IsLatest": n == 0, "LastModified": BENCHMARK_START + timedelta(seconds=date)}
+            if n < len(dates) - 1 and rng.random() < BENCHMARK_DELETE_MARKERS:
+                entries.append((True, entry))
+                continue
+            size = rng.randint(0, 64 * 1024) if rng.random() < 0.9 else rng.randint(1024 ** 2, 1024 ** 3)
+            entry.update({"Size": min(size, self.max_size) if self.max_size is not None else size, "ETag": '"%032x"' % rng.getrandbits(128),
+                          "StorageClass": rng.choices(("STANDARD", "STANDARD_IA", "GLACIER", "DEEP_ARCHIVE"), (80, 15, 4, 1))[0]})
+            entries.append((False, entry))
+        return entries
+
+    def entry(self, key, version_id):
+        return next(entry for is_dmarker, entry in self.history(int(key.rsplit("file", 1)[1])) if entry["VersionId"] == version_id)
+
+    def call(self, operation, fn):
+        # The request events are emitted like botocore does, so that the latency histograms are filled
+        context = {}
+        model = types.SimpleNamespace(name=operation)
+        self.meta.events.emit("before-call.s3." + operation, model=model, params={}, context=context)
+        try:
+            result = fn()
+        except botocore.exceptions.ClientError as ex:
+            self.meta.events.emit("after-call.s3." + operation, http_response=types.SimpleNamespace(status_code=404), parsed=ex.response, model=model, context=context)
+            raise
+        self.meta.events.emit("after-call.s3." + operation, http_response=types.SimpleNamespace(status_code=200), parsed=result, model=model, context=context)
+        return result
+
+    def get_paginator(self, operation):
+        if operation != "list_object_versions":
+            raise NotImplementedError("the S3 stand-in only lists versions")
+        return types.SimpleNamespace(paginate=self.paginate)
+
+    def paginate(self, Bucket, Prefix="", Delimiter=None, KeyMarker="", VersionIdMarker=None, MaxKeys=1000):
+        while True:
+            page = self.call("ListObjectVersions", lambda: self.list_page(Prefix, Delimiter, KeyMarker, VersionIdMarker, MaxKeys))
+            yield page
+            if not page["IsTruncated"]:
+                return
+            KeyMarker, VersionIdMarker = page["NextKeyMarker"], page["NextVersionIdMarker"]
+
+    def list_page(self, prefix, delimiter, key_marker, version_id_marker, max_keys):
+        page = {"Versions": [], "DeleteMarkers": [], "CommonPrefixes": [], "IsTruncated": False}
+        count = 0
+        # The listing goes on after the key marker, or inside it after the version id marker
+        number = max(self.first_key(prefix, after=False), self.first_key(key_marker, after=version_id_marker is None) if key_marker else 0)
+        while number < self.keys:
+            key = self.key(number)
+            if not key.startswith(prefix):
+                if key > prefix:
+                    break
+                number += 1
+                continue
+            if delimiter and delimiter in key[len(prefix):]:
+                common_prefix = key[:key.index(delimiter, len(prefix)) + 1]
+                page["CommonPrefixes"].append({"Prefix": common_prefix})
+                number = self.first_key(common_prefix + "\U0010ffff", after=True)
+                continue
+            entries = self.history(number)
+            if key == key_marker and version_id_marker is not None:
+                entries = entries[[entry["VersionId"] for is_dmarker, entry in entries].index(version_id_marker) + 1:]
+            for is_dmarker, entry in entries:
+                if count == max_keys:
+                    page.update(IsTruncated=True, NextKeyMarker=last["Key"], NextVersionIdMarker=last["VersionId"])
+                    return self.count_listed(page, count)
+                page["DeleteMarkers" if is_dmarker else "Versions"].append(entry)
+                last = entry
+                count += 1
+            number += 1
+        return self.count_listed(page, count)
+
+    def count_listed(self, page, count):
+        with self.lock:
+            self.listed += count
+        # Like S3, lists that would be empty are left out of the page
+        return {name: value for name, value in page.items() if value != []}
+
+    def get_object(self, Bucket, Key, VersionId, **kwargs):
+        return self.call("GetObject", lambda: {"Body": StubBody(self.entry(Key, VersionId)["Size"])})
+
+    def head_object(self, Bucket, Key, VersionId, **kwargs):
+        return self.call("HeadObject", lambda: dict(self.entry(Key, VersionId), Restore='ongoing-request="false", expiry-date="Fri, 1 Jan 2100 00:00:00 GMT"'))
+
+    def restore_object(self, **kwargs):
+        return self.call("RestoreObject", lambda: {})
+
+    def copy_object(self, **kwargs):
+        return self.call("CopyObject", lambda: {})
+
+    def delete_objects(self, Bucket, Delete):
+        return self.call("DeleteObjects", lambda: {})
+
+    def get_object_retention(self, **kwargs):
+        def no_retention():
+            raise botocore.exceptions.ClientError({"Error": {"Code": "NoSuchObjectLockConfiguration", "Message": "No retention"}}, "GetObjectRetention")
+        return self.call("GetObjectRetention", no_retention)
+
+def run_forked(function, *function_args):
+    # Runs the function in a forked process, so that the restore state and the peak memory of a test are its own
+    import multiprocessing
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("fork")) as pool:
+        return pool.submit(function, *function_args).result()
+
+def use_stub_s3(keys, max_size=None, transfer_manager=None):
+    # In a process of run_forked: throws its output away and makes StubS3 the client of the restore. Returns the stub
+    global create_transfer_manager
+    import_boto3()
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    stub = StubS3(keys, max_size=max_size)
+    boto3.client = lambda *client_args, **client_kwargs: stub
+    create_transfer_manager = lambda client, config: transfer_manager
+    return stub
+
+def run_benchmark(scenario, keys):
+    # Runs in a process of its own, with its output thrown away: the results are only the measures.
+    # The benchmarks only use single request transfers, the transfer manager is never called
+    stub = use_stub_s3(keys if scenario != "local" else max(1, keys // BENCHMARK_LOCAL_RATIO), max_size=64 * 1024 if scenario == "local" else None)
+    args.bucket = BENCHMARK_BUCKET
+    args.prefix = args.dest_prefix = ""
+    args.timestamp = [BENCHMARK_TIMESTAMP]
+    args.from_timestamp = args.summary_out = args.metrics_out = args.progress = None
+    args.small_object_threshold = 1024 ** 4
+    if scenario == "delete":
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import delete_old_version
+        start = time.monotonic()
+        delete_old_version.delete_non_current_versions(None, BENCHMARK_BUCKET, max_workers=args.max_workers)
+        return {"delete_versions_per_second": stub.listed / (time.monotonic() - start), "peak_rss": peak_rss()}
+    if scenario == "local":
+        args.dest_bucket = None
+        args.dest = tempfile.mkdtemp()
+    else:
+        # A restore in place, with the deletes of the keys created after the point in time
+        args.dest_bucket = BENCHMARK_BUCKET
+        args.dest = ""
+    try:
+        do_restore()
+    finally:
+        if args.dest:
+            shutil.rmtree(args.dest)
+    summary = get_summary()
+    results = {"transfer_objects_per_second": summary["ObjectsPerSecond"], "peak_rss": summary["PeakRSS"]}
+    if scenario == "restore":
+        results.update({"listing_versions_per_second": summary["Listed"] / summary["Phases"]["listing"], "resolve_seconds": summary["Phases"]["resolve"]})
+    return results
+
+class TestBenchmark(unittest.TestCase):
+    # Runs offline against StubS3, each scenario in a forked process so that its peak memory is its own. The measures
+    # are compared with a baseline of a previous run when there's one, otherwise they are recorded as the baseline
+
+    results = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.baseline = None
+        if args.benchmark_baseline and os.path.exists(args.benchmark_baseline):
+            with open(args.benchmark_baseline) as baseline_file:
+                cls.baseline = json.load(baseline_file)
+
+    @classmethod
+    def tearDownClass(cls):
+        if args.benchmark_baseline and cls.baseline is None and cls.results:
+            with open(args.benchmark_baseline, "w") as baseline_file:
+                json.dump({"Keys": args.benchmark_keys, "Results": cls.results}, baseline_file, indent=2)
+            print("Benchmark baseline recorded in %s" % args.benchmark_baseline)
+
+    def run_scenario(self, scenario):
+        results = run_forked(run_benchmark, scenario, args.benchmark_keys)
+        print("%s: %s" % (scenario, ", ".join("%s %.1f" % (name, value) for name, value in sorted(results.items()))))
+        self.results[scenario] = results
+        if self.baseline is None:
+            return
+        self.assertEqual(self.baseline["Keys"], args.benchmark_keys, "the baseline was recorded with another --benchmark-keys")
+        # Rates have to stay above the baseline, times and memory below it, both within the tolerance
+        regressions = []
+        for name, value in sorted(results.items()):
+            expected = self.baseline["Results"].get(scenario, {}).get(name)
+            if expected is None:
+                continue
+            if name.endswith("_per_second") and value < expected * (1 - args.benchmark_tolerance) or \
+               not name.endswith("_per_second") and value > expected * (1 + args.benchmark_tolerance):
+                regressions.append("%s %.1f (baseline %.1f)" % (name, value, expected))
+        if regressions:
+            self.fail("%s regressed: %s" % (scenario, ", ".join(regressions)))
+
+    def test_restore(self):
+        self.run_scenario("restore")
+
+    def test_local_restore(self):
+        self.run_scenario("local")
+
+    def test_delete_old_versions(self):
+        self.run_scenario("delete")
+
+class TestSkipExisting(unittest.TestCase):
+    # Runs offline, the destination is a listing and HEAD responses made up by the test
+
+    def setUp(self):
+        global args, client, dest_objs
+        self.saved = (args, client, dest_objs)
+        args = make_args({"bucket": "bucket", "dest_bucket": "bucket", "skip_existing": True})
+        self.checksums = {}
+        client = types.SimpleNamespace(head_object=lambda Bucket, Key, VersionId=None, **kwargs: self.checksums.get((Bucket, Key, VersionId), {}))
+
+    def tearDown(self):
+        global args, client, dest_objs
+        args, client, dest_objs = self.saved
+
+    def test_multipart_in_place(self):
+        global dest_objs
+        version = Version("key", "v1", datetime(2020, 1, 1, tzinfo=timezone.utc), 8, "STANDARD", '"aaaa-8"', is_latest=False)
+        # The object at the key is a newer one of the same size, written after the version
+        dest_objs = {"key": ('"bbbb-8"', 8)}
+        self.assertFalse(is_restored(version))
+        self.assertTrue(is_restored(dict(version, IsLatest=True)))
+        # A copy made by a previous restore has the full object checksum of the version, not a composite one
+        self.checksums = {("bucket", "key", "v1"): {"ChecksumCRC64NVME": "c1"}, ("bucket", "key", None): {"ChecksumCRC64NVME": "c1", "ChecksumCRC32": "x-8"}}
+        self.assertTrue(is_restored(version))
+        self.checksums[("bucket", "key", None)] = {"ChecksumCRC64NVME": "c2"}
+        self.assertFalse(is_restored(version))
+
+def run_resume(checkpoint_path):
+    # Runs in a process of its own like the benchmarks: resumes the restore of the checkpoint in place against StubS3
+    global args
+    stub = use_stub_s3(1000)
+    deleted = []
+    stub.meta.events.register("before-call.s3.DeleteObjects", lambda **kwargs: deleted.append(kwargs))
+    args = make_args({"bucket": BENCHMARK_BUCKET, "dest_bucket": BENCHMARK_BUCKET, "checkpoint": checkpoint_path, "resume": True,
+                      "small_object_threshold": 1024 ** 4})
+    do_restore()
+    return len(deleted), get_summary()["Restored"]
+
+class TestResume(unittest.TestCase):
+    # Runs offline against StubS3, in a forked process so that the restore state stays out of the other tests
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "checkpoint.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_resume_snapshots(self):
+        # Journal of a restore of two points in time to the same bucket, interrupted before its first page:
+        # resumed without -t, it restores the same snapshots and never deletes the current keys
+        with open(self.path, "w") as journal_file:
+            journal_file.write(json.dumps({"Bucket": BENCHMARK_BUCKET, "Prefix": "", "FromTimestamp": datetime.fromtimestamp(0, timezone.utc).isoformat(),
+                                           "Timestamps": ["2020-04-01T00:00:00+00:00", BENCHMARK_TIMESTAMP], "Shards": [{"Prefix": ""}]}) + "\n")
+        deleted, restored = run_forked(run_resume, self.path)
+        self.assertEqual(deleted, 0)
+        self.assertGreater(restored, 0)
+
+def run_session(tmpdir):
+    # Runs in a process of its own like the benchmarks: consecutive restores of a session against StubS3
+    stub = use_stub_s3(200, max_size=4096, transfer_manager=types.SimpleNamespace(shutdown=lambda: None))
+    get_object = stub.get_object
+    def interrupting_get_object(**kwargs):
+        # Interrupted from a transfer, like by a SIGINT
+        if args.prefix == "folder01/":
+            stop_restore()
+        return get_object(**kwargs)
+    stub.get_object = interrupting_get_object
+    results = []
+    with RestoreSession(max_workers=4, small_object_threshold=1024 ** 2) as session:
+        options = {"bucket": BENCHMARK_BUCKET, "timestamp": BENCHMARK_TIMESTAMP}
+        session.restore(prefix="folder00/", archive=os.path.join(tmpdir, "restore.tar"), **options)
+        with tarfile.open(os.path.join(tmpdir, "restore.tar")) as tar:
+            results.append(len(tar.getnames()))
+        results.append(session.restore(prefix="folder00/", dest=os.path.join(tmpdir, "restored"), **options)["Failed"])
+        try:
+            session.restore(prefix="folder01/", dest=os.path.join(tmpdir, "interrupted"), **options)
+        except RestoreError:
+            results.append("interrupted")
+        results.append(session.restore(prefix="folder02/", dest=os.path.join(tmpdir, "restored"), **options)["Failed"])
+    results.append(sorted(os.listdir(os.path.join(tmpdir, "restored"))))
+    return results
+
+class TestSession(unittest.TestCase):
+    # Runs offline against StubS3, in a forked process so that the session state stays out of the other tests
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_consecutive_restores(self):
+        # An archive doesn't outlive its restore, and an interrupted restore doesn't stop the next ones
+        archived, failed, interrupted, failed_after, restored = run_forked(run_session, self.tmpdir)
+        self.assertGreater(archived, 0)
+        self.assertEqual((failed, interrupted, failed_after), (0, "interrupted", 0))
+        self.assertEqual(restored, ["folder00", "folder02"])
+
+class TestVerify(unittest.TestCase):
+    # Runs offline on files written in a temporary directory, no bucket needed
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "file")
+        self.data = bytes(range(256)) * 40
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_etags(self):
+        self.assertEqual(hash_file(self.path, "md5", None), hashlib.md5(self.data).hexdigest())
+        # Multipart ETag of an upload in parts of 4 KB: 3 parts, the last one shorter
+        parts = b"".join(hashlib.md5(self.data[start:start + 4096]).digest() for start in range(0, len(self.data), 4096))
+        self.assertEqual(hash_file(self.path, "md5", 4096), hashlib.md5(parts).hexdigest() + "-3")
+
+    def test_checksums(self):
+        self.assertEqual(hash_file(self.path, "sha256", None), base64.b64encode(hashlib.sha256(self.data).digest()).decode())
+        self.assertEqual(hash_file(self.path, "crc32", None), base64.b64encode(zlib.crc32(self.data).to_bytes(4, "big")).decode())
+        open(self.path, "wb").close()
+        self.assertEqual(hash_file(self.path, "md5", None), hashlib.md5(b"").hexdigest())
+
 def signal_handler(signal, frame):
-    executor.shutdown(wait=False)
+    stop_restore()
+    print("Gracefully exiting ...")
+
+def stop_restore():
+    interrupted.set()
+    # The async engine has no executor, its tasks are cancelled by wait_async
+    if executor is not None:
+        executor.shutdown(wait=False)
     for future in list(futures.keys()):
         if not future.running():
             future.cancel()
             futures.pop(future, None)
-    print("Gracefully exiting ...")
 
 def print_obj(obj, optional_message=""):
-    if args.verbose:
-        print('"%s" %s %s %s %s %s' % (obj["LastModified"], obj["VersionId"], obj["Size"], obj["StorageClass"], obj["Key"], optional_message))
+    with print_lock:
+        for path in get_paths(obj):
+            if args.verbose:
+                print('"%s" %s %s %s %s %s' % (obj["LastModified"], obj["VersionId"], obj["Size"], obj["StorageClass"], path, optional_message))
+            else:
+                print(path)
+
+def print_error(obj, ex):
+    with print_lock:
+        print('"%s" %s %s %s %s "ERROR: %s"' % (obj["LastModified"], obj["VersionId"], obj["Size"], obj["StorageClass"], obj["Key"], ex), file=sys.stderr)
+
+def settle_future(future):
+    obj = futures.pop(future, None)
+    if future in unbounded_futures:
+        unbounded_futures.discard(future)
     else:
-        print(obj["Key"])
+        inflight.release()
+    if future.cancelled():
+        return None
+    return obj
+
+def report_future(future):
+    obj = settle_future(future)
+    if obj is None:
+        return
+    try:
+        future.result()
+        print_obj(obj)
+        release_obj(obj, failed=False)
+        count_obj(failed=False, size=obj.get("Size") or 0)
+        record_verify(obj)
+        settle_dedup(obj, failed=False)
+    except Exception as ex:
+        print_error(obj, ex)
+        release_obj(obj, failed=True)
+        replan_obj(obj)
+        count_obj(failed=True)
+        settle_dedup(obj, failed=True)
+
+def report_batch(future):
+    batch = settle_future(future)
+    if batch is None:
+        return
+    try:
+        errors = future.result()
+    except Exception as ex:
+        errors = {obj["Key"]: ex for obj in batch}
+    for obj in batch:
+        if obj["Key"] in errors:
+            print_error(obj, errors[obj["Key"]])
+            replan_obj(obj)
+            count_obj(failed=True)
+        else:
+            print_obj(obj)
+            # Deletes are counted with the restored objects, without any size
+            count_obj(failed=False)
+            if checkpoint is not None:
+                journal({"Deleted": obj["Key"]})
+
+def submit(fn, obj, report=report_future, bounded=True):
+    # Blocks while too many transfers are in flight: the listing stops being drained and waits as well.
+    # Reports run on the workers and can't wait for the slots the workers free, what they submit isn't bounded
+    if bounded and not inflight.acquire(blocking=False):
+        start = time.monotonic()
+        inflight.acquire()
+        time_phase("submit_wait", start)
+    try:
+        future = executor.submit(run_request, fn, obj)
+    except RuntimeError:
+        if bounded:
+            inflight.release()
+        return False
+    futures[future] = obj
+    if not bounded:
+        unbounded_futures.add(future)
+    track_obj(obj)
+    with concurrency_cond:
+        concurrency["Reporting"] += 1
+    future.add_done_callback(lambda future: run_report(report, future))
+    return True
+
+def run_report(report, future):
+    try:
+        report(future)
+    finally:
+        with concurrency_cond:
+            concurrency["Reporting"] -= 1
+            concurrency_cond.notify_all()
+
+def run_request(fn, obj):
+    # Throttled requests are retried with a jittered backoff, after the backoff of their prefix
+    prefix = request_prefix(obj)
+    for attempt in range(args.throttle_retries + 1):
+        wait_prefix(prefix)
+        acquire_request()
+        start = time.monotonic()
+        try:
+            result = fn(obj)
+        except Exception as ex:
+            throttled = is_throttled(ex)
+            release_request(time.monotonic() - start, throttled)
+            if not throttled or attempt == args.throttle_retries:
+                raise
+            backoff_prefix(prefix, random.uniform(0, min(THROTTLE_MAX_DELAY, THROTTLE_BASE_DELAY * 2 ** attempt)))
+            continue
+        finally:
+            time_phase("requests", start)
+        release_request(time.monotonic() - start, False)
+        return result
+
+def is_throttled(ex):
+    if not isinstance(ex, botocore.exceptions.ClientError):
+        return False
+    return ex.response.get("Error", {}).get("Code") in THROTTLE_ERROR_CODES or ex.response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 503
+
+def request_prefix(obj):
+    # S3 throttles by key prefix, a batch of deletes is throttled on the prefix of its first key
+    return os.path.dirname((obj[0] if isinstance(obj, list) else obj)["Key"])
+
+def wait_prefix(prefix):
+    delay = prefix_backoff.get(prefix, 0) - time.monotonic()
+    if delay > 0:
+        interrupted.wait(delay)
+
+def backoff_prefix(prefix, delay):
+    with concurrency_cond:
+        concurrency["Retries"] += 1
+        prefix_backoff[prefix] = max(prefix_backoff.get(prefix, 0), time.monotonic() + delay)
+
+def init_concurrency(limit, max_limit):
+    concurrency.update({"Limit": limit, "MaxLimit": max_limit, "PeakLimit": limit, "Running": 0, "Window": 0, "Latency": None, "BestLatency": None,
+                        "LastDecrease": 0, "Requests": 0, "Retries": 0, "Throttled": 0, "Busy": 0.0, "Start": time.monotonic(), "Last": time.monotonic(),
+                        "Restored": 0, "Failed": 0, "Bytes": 0, "Deduplicated": 0, "SavedBytes": 0, "Verified": 0, "Mismatched": 0, "Reporting": 0})
+
+def count_running():
+    # Time weighted sum of the running requests, for the mean concurrency of the summary
+    now = time.monotonic()
+    concurrency["Busy"] += concurrency["Running"] * (now - concurrency["Last"])
+    concurrency["Last"] = now
 
-def handled_by_glacier(obj):
-    if (obj["StorageClass"] == "DEEP_ARCHIVE" or obj["StorageClass"] == "GLACIER") and not args.enable_glacier:
+def acquire_request():
+    with concurrency_cond:
+        while concurrency["Running"] >= concurrency["Limit"]:
+            concurrency_cond.wait()
+        count_running()
+        concurrency["Running"] += 1
+
+def release_request(latency, throttled):
+    # AIMD: the limit grows by one after a full window of healthy requests, and halves on throttling,
+    # at most once per latency so that a single burst of throttled requests halves it only once
+    with concurrency_cond:
+        count_running()
+        concurrency["Running"] -= 1
+        concurrency["Requests"] += 1
+        now = time.monotonic()
+        if throttled:
+            concurrency["Throttled"] += 1
+            if args.adaptive and now - concurrency["LastDecrease"] > (concurrency["Latency"] or latency):
+                concurrency["Limit"] = max(1, concurrency["Limit"] // 2)
+                concurrency["LastDecrease"] = now
+                concurrency["Window"] = 0
+        else:
+            concurrency["Latency"] = latency if concurrency["Latency"] is None else (1 - LATENCY_SMOOTHING) * concurrency["Latency"] + LATENCY_SMOOTHING * latency
+            concurrency["BestLatency"] = min(concurrency["BestLatency"] or concurrency["Latency"], concurrency["Latency"])
+            concurrency["Window"] += 1
+            if args.adaptive and concurrency["Window"] >= concurrency["Limit"] and concurrency["Latency"] <= LATENCY_HEALTHY_FACTOR * concurrency["BestLatency"]:
+                concurrency["Limit"] = min(concurrency["MaxLimit"], concurrency["Limit"] + 1)
+                concurrency["PeakLimit"] = max(concurrency["PeakLimit"], concurrency["Limit"])
+                concurrency["Window"] = 0
+        concurrency_cond.notify_all()
+
+def count_obj(failed, size=0, saved=0):
+    with concurrency_cond:
+        if failed:
+            concurrency["Failed"] += 1
+            return
+        concurrency["Restored"] += 1
+        concurrency["Bytes"] += size
+        if saved:
+            concurrency["Deduplicated"] += 1
+            concurrency["SavedBytes"] += saved
+
+def get_summary():
+    with concurrency_cond:
+        count_running()
+        summary = {"Shards": ["%d/%d" % args.shard] if args.shard else [], "Restored": concurrency["Restored"], "Failed": concurrency["Failed"],
+                "Bytes": concurrency["Bytes"], "Requests": concurrency["Requests"], "Throttled": concurrency["Throttled"], "Retries": concurrency["Retries"],
+                "Busy": concurrency["Busy"], "Elapsed": concurrency["Last"] - concurrency["Start"], "Limit": concurrency["Limit"],
+                "PeakLimit": concurrency["PeakLimit"], "PeakRSS": peak_rss(), "Deduplicated": concurrency["Deduplicated"], "SavedBytes": concurrency["SavedBytes"],
+                   "Verified": concurrency["Verified"], "Mismatched": concurrency["Mismatched"]}
+    with metrics_lock:
+        summary.update({"Listed": metrics["Listed"], "Phases": dict(metrics["Phases"]),
+                        "Operations": {name: dict(operation, Buckets=list(operation["Buckets"])) for name, operation in metrics["Operations"].items()}})
+    return add_rates(summary)
+
+def add_rates(summary):
+    summary["ObjectsPerSecond"] = summary["Restored"] / summary["Elapsed"] if summary["Elapsed"] else 0
+    summary["BytesPerSecond"] = summary["Bytes"] / summary["Elapsed"] if summary["Elapsed"] else 0
+    return summary
+
+def merge_summaries(summaries):
+    # Nodes run side by side: counts and concurrencies add up, the restore lasts as long as the slowest node
+    merged = {"Shards": sorted(shard for summary in summaries for shard in summary["Shards"]), "Elapsed": max(summary["Elapsed"] for summary in summaries),
+              "PeakRSS": max(summary["PeakRSS"] for summary in summaries)}
+    for name in ("Restored", "Failed", "Bytes", "Requests", "Throttled", "Retries", "Busy", "Limit", "PeakLimit", "Deduplicated", "SavedBytes", "Listed", "Verified", "Mismatched"):
+        merged[name] = sum(summary.get(name, 0) for summary in summaries)
+    merged["Phases"] = collections.Counter()
+    merged["Operations"] = {}
+    for summary in summaries:
+        merged["Phases"].update(summary.get("Phases", {}))
+        for name, operation in summary.get("Operations", {}).items():
+            total = merged["Operations"].setdefault(name, new_operation())
+            total["Buckets"] = [count + other for count, other in zip(total["Buckets"], operation["Buckets"])]
+            for field in ("Count", "Sum", "Errors"):
+                total[field] += operation[field]
+    merged["Phases"] = dict(merged["Phases"])
+    return add_rates(merged)
+
+def print_summary(summary=None):
+    if summary is None:
+        # The progress line stops before the summary, which is also the last write of the metrics
+        progress_stop.set()
+        summary = get_summary()
+        if args.summary_out:
+            with open(args.summary_out, "w") as summary_file:
+                json.dump(summary, summary_file)
+        if args.metrics_out:
+            write_metrics(summary)
+    print("Summary%s: %d restored (%.1f MB), %d deduplicated (%.1f MB saved), %d failed, %d requests, %d throttled, %d retries, concurrency %.1f mean, "
+          "%d final limit, %d peak limit, %.1f MB peak RSS" %
+          (" of shards " + ", ".join(summary["Shards"]) if summary["Shards"] else "", summary["Restored"], summary["Bytes"] / 1024 ** 2,
+           summary.get("Deduplicated", 0), summary.get("SavedBytes", 0) / 1024 ** 2, summary["Failed"],
+           summary["Requests"], summary["Throttled"], summary["Retries"], summary["Busy"] / summary["Elapsed"] if summary["Elapsed"] else 0,
+           summary["Limit"], summary["PeakLimit"], summary["PeakRSS"] / 1024 ** 2), file=sys.stderr)
+    print("Throughput: %d listed, %.1f objects/s, %.1f MB/s over %.1f s" %
+          (summary.get("Listed", 0), summary.get("ObjectsPerSecond", 0), summary.get("BytesPerSecond", 0) / 1024 ** 2, summary["Elapsed"]), file=sys.stderr)
+    if summary.get("Verified") or summary.get("Mismatched"):
+        print("Verification: %d verified, %d mismatched" % (summary["Verified"], summary["Mismatched"]), file=sys.stderr)
+    # Phases add up the time of all the threads, the requests of the workers include their glacier and filesystem time
+    if summary.get("Phases"):
+        print("Phases: " + ", ".join("%s %.1f s" % (phase, seconds) for phase, seconds in sorted(summary["Phases"].items())), file=sys.stderr)
+    if summary.get("Operations"):
+        print("Latency: " + ", ".join("%s %d (p50 %s, p99 %s, %d errors)" % (name, operation["Count"], latency_quantile(operation, 0.5),
+                                                                            latency_quantile(operation, 0.99), operation["Errors"])
+                                       for name, operation in sorted(summary["Operations"].items())), file=sys.stderr)
+
+def peak_rss():
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def init_metrics():
+    # Each restore of the same process starts from zero, like its concurrency
+    metrics.update({"Phases": collections.defaultdict(float), "Operations": {}, "Listed": 0, "ListingDone": False})
+
+def time_phase(phase, start):
+    with metrics_lock:
+        metrics["Phases"][phase] += time.monotonic() - start
+
+def timed_pages(pages, phase):
+    # Only the time spent getting the next page is counted, not the time of the consumer between two pages
+    pages = iter(pages)
+    while True:
+        start = time.monotonic()
+        page = next(pages, None)
+        time_phase(phase, start)
+        if page is None:
+            return
+        yield page
+
+def count_listed(count):
+    with metrics_lock:
+        metrics["Listed"] += count
+
+def new_operation():
+    return {"Buckets": [0] * (len(LATENCY_BUCKETS) + 1), "Count": 0, "Sum": 0.0, "Errors": 0}
+
+def before_request(model, context, **kwargs):
+    context["RequestOperation"] = model.name
+    context["RequestStart"] = time.monotonic()
+
+def after_request(context, http_response=None, **kwargs):
+    # The latency is the one of the response headers, streamed bodies are read after it
+    if "RequestStart" not in context:
+        return
+    latency = time.monotonic() - context["RequestStart"]
+    failed = http_response is None or http_response.status_code >= 400
+    with metrics_lock:
+        operation = metrics["Operations"].setdefault(context["RequestOperation"], new_operation())
+        operation["Buckets"][next((n for n, bound in enumerate(LATENCY_BUCKETS) if latency <= bound), len(LATENCY_BUCKETS))] += 1
+        operation["Count"] += 1
+        operation["Sum"] += latency
+        if failed:
+            operation["Errors"] += 1
+
+def latency_quantile(operation, quantile):
+    # Upper bound of the bucket holding the quantile
+    rank = quantile * operation["Count"]
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS, operation["Buckets"]):
+        seen += count
+        if seen >= rank:
+            return "%gs" % bound
+    return ">%gs" % LATENCY_BUCKETS[-1]
+
+def start_progress():
+    # Each restore has its own stop event, so that a progress thread never outlives its restore
+    global progress_stop
+    progress_stop = threading.Event()
+    if args.progress or args.metrics_out:
+        threading.Thread(target=report_progress, args=(progress_stop,), daemon=True).start()
+
+def report_progress(stop):
+    previous = get_summary()
+    while not stop.wait(args.progress or METRICS_INTERVAL):
+        summary = get_summary()
+        if args.progress:
+            print_progress(summary, previous)
+        if args.metrics_out:
+            write_metrics(summary)
+        previous = summary
+
+def print_progress(summary, previous):
+    # Rates are the ones of the last interval. The remaining versions are known once the listing is over:
+    # they are the ones still queued or in flight
+    interval = summary["Elapsed"] - previous["Elapsed"]
+    done = summary["Restored"] + summary["Failed"] - previous["Restored"] - previous["Failed"]
+    rate = done / interval if interval else 0
+    remaining = (work_queue.qsize() if work_queue is not None else 0) + len(futures)
+    if not metrics["ListingDone"]:
+        eta = "unknown while listing"
+    elif rate:
+        eta = str(timedelta(seconds=int(remaining / rate)))
+    else:
+        eta = "unknown"
+    with print_lock:
+        print("Progress: %d listed, %d restored (%.1f MB), %d failed, %.1f objects/s, %.1f MB/s, %d queued, %d in flight, ETA %s" %
+              (summary["Listed"], summary["Restored"], summary["Bytes"] / 1024 ** 2, summary["Failed"], rate,
+               (summary["Bytes"] - previous["Bytes"]) / interval / 1024 ** 2 if interval else 0,
+               work_queue.qsize() if work_queue is not None else 0, len(futures), eta), file=sys.stderr)
+
+def write_metrics(summary):
+    # Prometheus text format, for the textfile collector of the node exporter. The file is replaced at once so
+    # that it's never scraped half written
+    lines = []
+    def metric(name, kind, help, samples):
+        lines.append("# HELP s3_pit_restore_%s %s" % (name, help))
+        lines.append("# TYPE s3_pit_restore_%s %s" % (name, kind))
+        for suffix, labels, value in samples:
+            lines.append("s3_pit_restore_%s%s%s %s" % (name, suffix, "{%s}" % ",".join('%s="%s"' % label for label in labels) if labels else "", value))
+    operations = sorted(summary["Operations"].items())
+    buckets = []
+    for name, operation in operations:
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), operation["Buckets"]):
+            seen += count
+            buckets.append(("_bucket", (("operation", name), ("le", bound)), seen))
+        buckets.append(("_sum", (("operation", name),), operation["Sum"]))
+        buckets.append(("_count", (("operation", name),), operation["Count"]))
+    metric("objects_total", "counter", "Versions restored or failed.", [("", (("status", "restored"),), summary["Restored"]), ("", (("status", "failed"),), summary["Failed"])])
+    metric("listed_total", "counter", "Versions listed.", [("", (), summary["Listed"])])
+    metric("bytes_total", "counter", "Bytes restored.", [("", (), summary["Bytes"])])
+    metric("deduplicated_bytes_total", "counter", "Bytes not transferred thanks to the deduplication.", [("", (), summary["SavedBytes"])])
+    metric("throttled_total", "counter", "Requests throttled by S3.", [("", (), summary["Throttled"])])
+    metric("retries_total", "counter", "Retries of throttled requests.", [("", (), summary["Retries"])])
+    metric("phase_seconds_total", "counter", "Time spent in each phase, summed over the threads.", [("", (("phase", phase),), seconds) for phase, seconds in sorted(summary["Phases"].items())])
+    metric("request_duration_seconds", "histogram", "Latency of the S3 requests until their response headers.", buckets)
+    metric("request_errors_total", "counter", "S3 requests which failed.", [("", (("operation", name),), operation["Errors"]) for name, operation in operations])
+    metric("queue_depth", "gauge", "Listed versions waiting to be transferred.", [("", (), work_queue.qsize() if work_queue is not None else 0)])
+    metric("inflight", "gauge", "Transfers submitted to the workers.", [("", (), len(futures))])
+    metric("concurrency_limit", "gauge", "Max number of running requests.", [("", (), summary["Limit"])])
+    metric("elapsed_seconds", "gauge", "Time since the start of the restore.", [("", (), summary["Elapsed"])])
+    with open(args.metrics_out + ".tmp", "w") as metrics_file:
+        metrics_file.write("\n".join(lines) + "\n")
+    os.replace(args.metrics_out + ".tmp", args.metrics_out)
+
+def handled_by_glacier(obj, obj_needs_be_deleted):
+    if obj["StorageClass"] not in GLACIER_STORAGE_CLASSES:
+        return False
+    if not args.enable_glacier:
         print_obj(obj, optional_message='needs restore')
         return True
-    elif (obj["StorageClass"] == "DEEP_ARCHIVE" or obj["StorageClass"] == "GLACIER") and args.enable_glacier:
-        s3 = boto3.resource('s3', endpoint_url=args.endpoint_url, verify=False)
-        s3_obj = s3.Object(args.bucket, obj["Key"])
-        if s3_obj.restore is None:
-            print_obj(obj, optional_message='requesting')
-            if not args.dry_run:
+    # Restore requests and status polls run on the workers like the transfers, which start as soon as the
+    # version is ready
+    return submit(lambda obj: glacier_obj(obj, obj_needs_be_deleted), obj, report=report_glacier)
+
+def glacier_obj(obj, obj_needs_be_deleted):
+    start = time.monotonic()
+    status = glacier_status(obj)
+    time_phase("glacier", start)
+    if status != "ready" and args.wait and not args.dry_run:
+        # Queued before the future is done, so that wait_glacier never misses it
+        with glacier_lock:
+            glacier_pending.append(obj)
+    if status != "ready" or args.dry_run:
+        return status
+    if args.dest_bucket is not None and obj_needs_be_deleted is not None:
+        keep_from_delete(obj_needs_be_deleted, obj)
+    if args.dest_bucket is None:
+        make_dirs(obj)
+    get_transfer(obj)(obj)
+    return None
+
+def glacier_status(obj):
+    # Versions known to be ready are not polled again until their restored copy expires
+    state = glacier_state.get((obj["Key"], obj["VersionId"]))
+    if state is not None and state["Status"] == "ready" and datetime.fromisoformat(state["Expiry"]) > datetime.now(timezone.utc):
+        return "ready"
+
+    restore = client.head_object(Bucket=args.bucket, Key=obj["Key"], VersionId=obj["VersionId"]).get("Restore")
+    expiry = None
+    if restore is None:
+        if args.dry_run:
+            return "requesting"
+        try:
+            client.restore_object(Bucket=args.bucket, Key=obj["Key"], VersionId=obj["VersionId"], RestoreRequest={'Days': GLACIER_RESTORE_DAYS})
+            status = "requesting"
+        except botocore.exceptions.ClientError as ex:
+            if ex.response["Error"]["Code"] != "RestoreAlreadyInProgress":
+                raise
+            status = "in-progress"
+    elif 'ongoing-request="true"' in restore:
+        status = "in-progress"
+    else:
+        status = "ready"
+        expiry = parse(restore.split('expiry-date="')[1].split('"')[0]).isoformat() if 'expiry-date="' in restore else datetime.now(timezone.utc).isoformat()
+    save_glacier_state(obj, status, expiry)
+    return status
+
+def report_glacier(future):
+    obj = settle_future(future)
+    if obj is None:
+        return
+    try:
+        status = future.result()
+    except Exception as ex:
+        print_error(obj, ex)
+        release_obj(obj, failed=True)
+        replan_obj(obj)
+        count_obj(failed=True)
+        return
+    if status is None or status == "ready":
+        print_obj(obj)
+        release_obj(obj, failed=False)
+        if status is None:
+            count_obj(failed=False, size=obj.get("Size") or 0)
+            record_verify(obj)
+        return
+    print_obj(obj, optional_message=status)
+    # Still archived: a resumed restore polls it again, and so does --wait once the listing is done
+    release_obj(obj, failed=True)
+    if not args.wait:
+        replan_obj(obj)
+
+def load_glacier_state(path):
+    global glacier_state_file
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
                 try:
-                    s3_obj.restore_object(VersionId=obj["VersionId"], RestoreRequest={'Days': 3},)
-                except botocore.exceptions.ClientError as ex:
-                    # sometimes s3_obj.restore returns None also if restore is in progress
-                    pass
-            return True
-        # Print out objects whose restoration is on-going
-        elif 'ongoing-request="true"' in s3_obj.restore:
-            print_obj(obj, optional_message='in-progress')
-            return True
-        # Print out objects whose restoration is complete
-        elif 'ongoing-request="false"' in s3_obj.restore:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interruption
+                    continue
+                glacier_state[(entry["Key"], entry["VersionId"])] = entry
+    glacier_state_file = open(path, "a")
+
+def save_glacier_state(obj, status, expiry):
+    entry = {"Key": obj["Key"], "VersionId": obj["VersionId"], "Status": status, "Expiry": expiry}
+    with glacier_lock:
+        glacier_state[(obj["Key"], obj["VersionId"])] = entry
+        if glacier_state_file is not None:
+            glacier_state_file.write(json.dumps(entry) + "\n")
+            glacier_state_file.flush()
+
+def wait_glacier(obj_needs_be_deleted):
+    # The archived versions still being restored are polled with a growing delay, and each one is
+    # transferred as soon as a poll finds it ready
+    delay = GLACIER_POLL_DELAY
+    while glacier_pending:
+        print("Waiting %d seconds for %d archived versions to be restored ..." % (delay, len(glacier_pending)), file=sys.stderr)
+        if interrupted.wait(delay):
             return False
-    else:
-        return False
+        with glacier_lock:
+            pending = list(glacier_pending)
+            del glacier_pending[:]
+        for obj in pending:
+            if not submit(lambda obj: glacier_obj(obj, obj_needs_be_deleted), obj, report=report_glacier):
+                return False
+        wait_futures()
+        delay = min(delay * 2, GLACIER_MAX_POLL_DELAY)
+    return True
 
 def handled_by_standard(obj):
     if args.dry_run:
         print_obj(obj)
     else:
+        if archive is not None:
+            return handled_by_archive(obj)
         if obj["Key"].endswith("/"):
-            if not os.path.exists(obj["Key"]):
-                os.makedirs(obj["Key"])
+            start = time.monotonic()
+            for path in get_paths(obj):
+                if not os.path.exists(path):
+                    os.makedirs(path)
+            time_phase("filesystem", start)
             return True
-        key_path = os.path.dirname(obj["Key"])
-        if key_path and not os.path.exists(key_path):
-                os.makedirs(key_path)
-        try:
-            future = executor.submit(download_file, obj)
-            global futures
-            futures[future] = obj
-        except RuntimeError:
-            return False
+        make_dirs(obj)
+        handled = dedup_obj(obj) if args.dedup else None
+        if handled is not None:
+            return handled
+        return submit(get_transfer(obj), obj)
     return True
 
+def handled_by_archive(obj):
+    # Versions are numbered in the order they are submitted and written to the archive in that order, whatever
+    # order their downloads complete in. The listing waits while too many versions are ahead of the next one
+    global archive_seq
+    with archive_cond:
+        while archive_seq - archive_next >= args.max_workers * ARCHIVE_REORDER_PER_WORKER and not interrupted.is_set():
+            archive_cond.wait(1)
+        obj = dict(obj, ArchiveSeq=archive_seq)
+        archive_seq += 1
+    return submit(fetch_archive_obj, obj, report=report_archive)
+
+def fetch_archive_obj(obj):
+    # Small bodies are read in memory by the workers, big ones are streamed by the archive writer in their turn
+    if obj["Key"].endswith("/") or not is_small(obj):
+        return None
+    return client.get_object(Bucket=args.bucket, Key=obj["Key"], VersionId=obj["VersionId"])["Body"].read()
+
+def report_archive(future):
+    obj = settle_future(future)
+    if obj is None:
+        return
+    try:
+        entry = (obj, future.result(), None)
+    except Exception as ex:
+        entry = (obj, None, ex)
+    with archive_cond:
+        archive_buffer[obj["ArchiveSeq"]] = entry
+    drain_archive()
+
+def drain_archive():
+    # Whichever worker completes the next version writes it, and the versions buffered after it. The other workers
+    # never wait for the writer: they leave their version in the buffer, and the writer looks at the buffer again
+    # once it has let go of the lock, for the versions buffered while it held it
+    while True:
+        if not archive_write_lock.acquire(blocking=False):
+            return
+        try:
+            write_buffered()
+        finally:
+            archive_write_lock.release()
+        with archive_cond:
+            if archive_next not in archive_buffer:
+                return
+
+def write_buffered():
+    global archive_next
+    while True:
+        with archive_cond:
+            entry = archive_buffer.pop(archive_next, None)
+        if entry is None:
+            return
+        obj, data, error = entry
+        if error is None and archive["Truncated"]:
+            error = "archive %s is truncated" % archive["Path"]
+        if error is None:
+            try:
+                write_archive_obj(obj, data)
+            except Exception as ex:
+                error = ex
+        if error is None:
+            print_obj(obj)
+            release_obj(obj, failed=False)
+            count_obj(failed=False, size=obj.get("Size") or 0)
+        else:
+            print_error(obj, error)
+            release_obj(obj, failed=True)
+            replan_obj(obj)
+            count_obj(failed=True)
+        with archive_cond:
+            archive_next += 1
+            archive_cond.notify_all()
+
+def write_archive_obj(obj, data):
+    global archive_part
+    paths = get_paths(obj)
+    info = tarfile.TarInfo(paths[0])
+    info.mtime = get_mtime(obj)
+    if obj["Key"].endswith("/"):
+        for path in paths:
+            info = tarfile.TarInfo(path)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            info.mtime = get_mtime(obj)
+            archive["Tar"].addfile(info)
+        return
+    info.size = obj["Size"]
+    info.mode = 0o644
+    if data is not None:
+        archive["Tar"].addfile(info, io.BytesIO(data))
+    else:
+        body = client.get_object(Bucket=args.bucket, Key=obj["Key"], VersionId=obj["VersionId"])["Body"]
+        try:
+            archive["Tar"].addfile(info, body)
+        except Exception:
+            # Part of the version is already in the archive, which can't go on
+            archive["Truncated"] = True
+            print("Archive %s is truncated after %s, exiting ..." % (archive["Path"], obj["Key"]), file=sys.stderr)
+            stop_restore()
+            raise
+    # The same version restored in other snapshots is linked to the first one
+    for path in paths[1:]:
+        link = tarfile.TarInfo(path)
+        link.type = tarfile.LNKTYPE
+        link.linkname = paths[0]
+        link.mtime = info.mtime
+        archive["Tar"].addfile(link)
+    if args.archive_max_size and archive["Tar"].offset >= args.archive_max_size:
+        close_archive()
+        archive_part += 1
+        open_archive()
+
+def open_archive():
+    global archive
+    path = args.archive
+    if args.archive_max_size:
+        # Parts are numbered before the .tar extension, like restore-0000.tar.zst
+        base, tar, extension = path.partition(".tar")
+        path = "%s-%04d%s%s" % (base, archive_part, tar, extension)
+    if path.endswith((".zst", ".tzst")):
+        # zstandard is only needed by zstd archives
+        try:
+            import zstandard
+        except ImportError:
+            print("zstd archives need zstandard, install it with: pip install zstandard", file=sys.stderr)
+            sys.exit(1)
+        stream = zstandard.ZstdCompressor(threads=-1).stream_writer(open(path, "wb"))
+        archive = {"Path": path, "Tar": tarfile.open(fileobj=stream, mode="w|"), "Stream": stream, "Truncated": False}
+        return
+    compression = next((mode for extensions, mode in (((".gz", ".tgz"), "gz"), ((".bz2", ".tbz2"), "bz2"), ((".xz", ".txz"), "xz")) if path.endswith(extensions)), "")
+    archive = {"Path": path, "Tar": tarfile.open(path, mode="w|" + compression), "Stream": None, "Truncated": False}
+
+def close_archive():
+    archive["Tar"].close()
+    if archive["Stream"] is not None:
+        archive["Stream"].close()
+
 def handled_by_copy(obj):
     if args.dry_run:
         print_obj(obj)
         return True
-    future = executor.submit(s3_copy_object, obj)
-    global futures
-    futures[future] = obj
-    return True
+    handled = dedup_obj(obj) if args.dedup else None
+    if handled is not None:
+        return handled
+    return submit(get_transfer(obj), obj)
+
+def content_id(obj):
+    # Multipart ETags depend on the part size of each upload, only single part ETags identify a content
+    if obj.get("ETag") is None or "-" in obj["ETag"] or not obj.get("Size"):
+        return None
+    return obj["ETag"], obj["Size"]
+
+def dedup_obj(obj):
+    # The first version of a content is transferred, the next ones are made from its restored copy: right
+    # away once it's restored, or when it is if it's still in flight. Returns None for the versions to transfer
+    cid = content_id(obj)
+    if cid is None:
+        return None
+    with dedup_lock:
+        entry = dedup.get(cid)
+        if entry is None:
+            dedup[cid] = {"Obj": obj, "Done": False, "Waiting": []}
+            # Only restored contents can be forgotten, the ones in flight have versions waiting for them
+            while len(dedup) > DEDUP_MAX_CONTENTS and next(iter(dedup.values()))["Done"]:
+                dedup.popitem(last=False)
+            return None
+        if not entry["Done"]:
+            entry["Waiting"].append(obj)
+            track_obj(obj)
+            return True
+        first = entry["Obj"]
+    return submit(lambda obj: restore_dup(obj, first), obj, report=report_dup)
+
+def settle_dedup(obj, failed):
+    cid = content_id(obj) if args.dedup else None
+    if cid is None:
+        return
+    with dedup_lock:
+        entry = dedup.get(cid)
+        if entry is None or entry["Obj"] is not obj:
+            return
+        waiting = entry["Waiting"]
+        entry["Waiting"] = []
+        if failed:
+            del dedup[cid]
+        else:
+            entry["Done"] = True
+    # The waiting versions go to the workers like any other transfer, those of a content which failed to be
+    # restored are transferred on their own
+    for dup in waiting:
+        if failed:
+            submitted = submit(get_transfer(dup), dup, bounded=False)
+        else:
+            submitted = submit(lambda dup: restore_dup(dup, obj), dup, report=report_dup, bounded=False)
+        if submitted:
+            # Tracked again by its transfer
+            untrack_obj(dup)
+        else:
+            # The workers are shut down, the version is left to a resumed restore
+            release_obj(dup, failed=True)
+            replan_obj(dup)
+
+def report_dup(future):
+    obj = settle_future(future)
+    if obj is None:
+        return
+    try:
+        future.result()
+        print_obj(obj)
+        release_obj(obj, failed=False)
+        count_obj(failed=False, saved=obj["Size"])
+        record_verify(obj)
+    except Exception as ex:
+        print_error(obj, ex)
+        release_obj(obj, failed=True)
+        replan_obj(obj)
+        count_obj(failed=True)
+
+def restore_dup(obj, first):
+    if args.dest_bucket is not None:
+        # Server side copies from the first restored key, nothing goes through the network
+        extra_args = { }
+
+        if args.sse is not None:
+            extra_args['ServerSideEncryption'] = args.sse
+        if args.verify:
+            extra_args['ChecksumAlgorithm'] = VERIFY_COPY_CHECKSUM
+
+        source = {'Bucket': args.dest_bucket, 'Key': get_keys(first)[0]}
+        for key in get_keys(obj):
+            if is_small(obj):
+                client.copy_object(Bucket=args.dest_bucket, Key=key, CopySource=source, **extra_args)
+            else:
+                transfer.copy(source, args.dest_bucket, key, extra_args=extra_args).result()
+        return
+    source = get_paths(first)[0]
+    unixtime = get_mtime(obj)
+    for path in get_paths(obj):
+        # A hard link would share the mtime of the first version, it's only used when they have the same one
+        if unixtime == get_mtime(first):
+            link_file(source, path)
+            continue
+        clone_file(source, path)
+        os.utime(path, (unixtime, unixtime))
+
+def clone_file(source, path):
+    start = time.monotonic()
+    if os.path.lexists(path):
+        os.remove(path)
+    # A reflink shares the blocks of the file until one of them changes, otherwise the file is copied
+    with open(source, "rb") as source_file, open(path, "wb") as path_file:
+        try:
+            fcntl.ioctl(path_file.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            shutil.copyfileobj(source_file, path_file)
+    time_phase("filesystem", start)
+
+def make_dirs(obj):
+    start = time.monotonic()
+    for path in get_paths(obj):
+        key_path = os.path.dirname(path)
+        if key_path and not os.path.exists(key_path):
+                os.makedirs(key_path)
+    time_phase("filesystem", start)
+
+def get_transfer(obj):
+    if args.dest_bucket is not None:
+        return s3_copy_small_object if is_small(obj) else s3_copy_object
+    # The throttled transfer manager is kept for every download when the bandwidth is capped
+    if is_small(obj) and args.max_bandwidth is None:
+        return get_small_file
+    return download_file
+
+def is_small(obj):
+    # Small objects skip the transfer manager: one request each, without its temp files and futures bookkeeping
+    return obj.get("Size") is not None and obj["Size"] < args.small_object_threshold
+
+def get_small_file(obj):
+    paths = get_paths(obj)
+    response = client.get_object(Bucket=args.bucket, Key=obj["Key"], VersionId=obj["VersionId"])
+    with open(paths[0], "wb") as f:
+        for chunk in response["Body"].iter_chunks():
+            f.write(chunk)
+    unixtime = get_mtime(obj)
+    os.utime(paths[0],(unixtime, unixtime))
+    for path in paths[1:]:
+        link_file(paths[0], path)
 
 def download_file(obj):
-    transfer.download_file(args.bucket, obj["Key"], obj["Key"], extra_args={"VersionId": obj["VersionId"]})
-    unixtime = time.mktime(obj["LastModified"].timetuple())
-    os.utime(obj["Key"],(unixtime, unixtime))
+    paths = get_paths(obj)
+    transfer.download(args.bucket, obj["Key"], paths[0], extra_args={"VersionId": obj["VersionId"]}).result()
+    unixtime = get_mtime(obj)
+    os.utime(paths[0],(unixtime, unixtime))
+    # The same version restored in other snapshots is linked to the downloaded file
+    for path in paths[1:]:
+        link_file(paths[0], path)
+
+def get_mtime(obj):
+    return time.mktime(obj["LastModified"].timetuple())
+
+def list_dest_objs(dest_prefixes):
+    # One listing of the destination instead of a HEAD request per restored object
+    global dest_objs
+    dest_objs = {}
+    paginator = client.get_paginator('list_objects_v2')
+    for dest_prefix in dest_prefixes:
+        for page in paginator.paginate(Bucket=args.dest_bucket, Prefix=dest_prefix):
+            for dest_obj in page.get("Contents", []):
+                dest_objs[dest_obj["Key"]] = (dest_obj["ETag"], dest_obj["Size"])
+
+def head_checksums(bucket, key, version_id=None):
+    version = {"VersionId": version_id} if version_id is not None else {}
+    response = client.head_object(Bucket=bucket, Key=key, ChecksumMode="ENABLED", **version)
+    # Composite checksums of multipart uploads depend on their part size like the ETags, only full object ones are kept
+    return {name: response[name] for name in REMOTE_CHECKSUMS if response.get(name) and "-" not in response[name]}
+
+def compare_checksums(obj, key):
+    # Whether the copy at key has the content of the version, None when they have no full object checksum in common
+    source = head_checksums(args.bucket, obj["Key"], obj["VersionId"])
+    dest = head_checksums(args.dest_bucket, key)
+    common = [name for name in REMOTE_CHECKSUMS if name in source and name in dest]
+    if not common:
+        return None
+    return all(source[name] == dest[name] for name in common)
+
+def is_restored(obj):
+    if args.dest_bucket is not None:
+        keys = get_keys(obj)
+        # In place the key is restored when the version is still its current one, whatever was written after it isn't
+        if args.dest_bucket == args.bucket and keys == [obj["Key"]] and obj.get("IsLatest"):
+            return True
+        for key in keys:
+            if key not in dest_objs:
+                return False
+            etag, size = dest_objs[key]
+            if size != obj["Size"]:
+                return False
+            # Multipart ETags depend on the part size used by each upload or copy, the checksums tell instead
+            if "-" in obj["ETag"] or "-" in etag:
+                if compare_checksums(obj, key) is not True:
+                    return False
+            elif etag != obj["ETag"]:
+                return False
+        return True
+    for path in get_paths(obj):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if stat.st_size != obj["Size"] or int(stat.st_mtime) != int(get_mtime(obj)):
+            return False
+    return True
 
-def get_key(obj):
+def link_file(source, path):
+    start = time.monotonic()
+    if os.path.lexists(path):
+        os.remove(path)
+    try:
+        os.link(source, path)
+    except OSError:
+        shutil.copy2(source, path)
+    time_phase("filesystem", start)
+
+def get_paths(obj):
+    # A version chosen by several timestamps is restored once in each snapshot directory
+    if "Snapshots" not in obj:
+        return [obj["Key"]]
+    return [os.path.join(snapshot, obj["Key"]) for snapshot in obj["Snapshots"]]
+
+def get_keys(obj):
     if not args.dest_prefix:
-        return  obj["Key"]
-    return os.path.join(args.dest_prefix, obj["Key"])
+        return get_paths(obj)
+    return [os.path.join(args.dest_prefix, path) for path in get_paths(obj)]
 
 def s3_copy_object(obj):
     copy_source= {
@@ -268,154 +1809,1625 @@ def s3_copy_object(obj):
 
     if args.sse is not None:
         extra_args['ServerSideEncryption'] = args.sse
+    # Multipart copies can only be verified by a full object checksum
+    if args.verify:
+        extra_args['ChecksumAlgorithm'] = VERIFY_COPY_CHECKSUM
+
+    keys = get_keys(obj)
+    transfer.copy(copy_source, args.dest_bucket, keys[0], extra_args=extra_args).result()
+    # Other snapshots of the same version are copied from the first one, inside the destination bucket
+    for key in keys[1:]:
+        transfer.copy({'Bucket': args.dest_bucket, 'Key': keys[0]}, args.dest_bucket, key, extra_args=extra_args).result()
+
+def s3_copy_small_object(obj):
+    extra_args = { }
+
+    if args.sse is not None:
+        extra_args['ServerSideEncryption'] = args.sse
+    # Versions uploaded in parts keep a multipart ETag, their copy is verified by its checksum
+    if args.verify:
+        extra_args['ChecksumAlgorithm'] = VERIFY_COPY_CHECKSUM
 
-    client.copy(Bucket=args.dest_bucket, CopySource=copy_source, Key=get_key(obj), ExtraArgs=extra_args)
+    keys = get_keys(obj)
+    client.copy_object(Bucket=args.dest_bucket, Key=keys[0], CopySource={'Bucket': args.bucket, 'Key': obj["Key"], 'VersionId': obj["VersionId"]}, **extra_args)
+    for key in keys[1:]:
+        client.copy_object(Bucket=args.dest_bucket, Key=key, CopySource={'Bucket': args.dest_bucket, 'Key': keys[0]}, **extra_args)
 
-def handled_by_delete(obj):
+def handled_by_delete(batch):
+    if plan is not None and not args.apply:
+        for obj in batch:
+            write_plan(obj, "delete")
+        return True
     if args.dry_run:
-        print_obj(obj)
+        for obj in batch:
+            print_obj(obj)
         return True
-    future = executor.submit(s3_delete_object, obj)
-    global futures
-    futures[future] = obj
+    return submit(s3_delete_objects, batch, report=report_batch)
+
+def s3_delete_objects(batch):
+    response = client.delete_objects(Bucket=args.dest_bucket, Delete={'Objects': [{'Key': obj["Key"]} for obj in batch], 'Quiet': True})
+    # Quiet mode only reports the keys which could not be deleted
+    return {error["Key"]: "%s %s" % (error["Code"], error["Message"]) for error in response.get("Errors", [])}
+
+def delete_objs(objs):
+    batch = []
+    for obj in objs:
+        batch.append(obj)
+        if len(batch) == DELETE_BATCH_SIZE:
+            if not handled_by_delete(batch):
+                return False
+            batch = []
+    if batch and not handled_by_delete(batch):
+        return False
+    wait_futures()
     return True
 
-def s3_delete_object(obj):
-    client.delete_object(Bucket=args.dest_bucket, Key=obj["Key"])
+def wait_futures():
+    # Results are reported by report_future as soon as each transfer completes, in a callback which can
+    # still be running once the future is done: the wait lasts until all the callbacks are over
+    with concurrency_cond:
+        while concurrency["Reporting"]:
+            concurrency_cond.wait()
 
-def do_restore():
-    pit_start_date = (parse(args.from_timestamp) if args.from_timestamp else datetime.fromtimestamp(0, timezone.utc))
-    pit_end_date = (parse(args.timestamp) if args.timestamp else datetime.now(timezone.utc))
+def list_common_prefixes(prefix):
+    # Only the first page is read: a prefix with more than a page of keys and common prefixes isn't split further,
+    # so that discovery never lists what the shards list again
+    page = next(iter(client.get_paginator('list_object_versions').paginate(Bucket=args.bucket, Prefix=prefix, Delimiter='/')))
+    prefixes = [common_prefix["Prefix"] for common_prefix in page.get("CommonPrefixes", [])]
+    has_keys = "Versions" in page or "DeleteMarkers" in page
+    return prefixes, has_keys, page.get("IsTruncated", False)
+
+def split_key_range(prefix):
+    # Shards cover the key ranges (KeyMarker, EndKey], the first one has no lower bound and the last one no upper bound
+    step = len(KEY_RANGE_ALPHABET) / args.listing_workers
+    bounds = sorted(set(prefix + KEY_RANGE_ALPHABET[int(i * step)] for i in range(1, args.listing_workers)))
+    lower_bounds = [None] + bounds
+    upper_bounds = bounds + [None]
+    shards = []
+    for lower, upper in zip(lower_bounds, upper_bounds):
+        shard = {"Prefix": prefix}
+        if lower is not None:
+            shard["KeyMarker"] = lower
+        if upper is not None:
+            shard["EndKey"] = upper
+        shards.append(shard)
+    return shards
+
+def discover_shards(listing_executor):
+    # With a single worker the whole prefix is listed at once, exactly like a plain paginated listing
+    if args.listing_workers < 2:
+        return [{"Prefix": args.prefix}]
+    shards = []
+    level = [args.prefix]
+    for depth in range(SHARD_DISCOVERY_DEPTH):
+        next_level = []
+        for prefix, (prefixes, has_keys, truncated) in zip(level, listing_executor.map(list_common_prefixes, level)):
+            if truncated:
+                # Big or flat keyspace under the restored prefix: key ranges split it whatever its layout
+                if depth == 0:
+                    return split_key_range(args.prefix)
+                shards.append({"Prefix": prefix})
+                continue
+            # Keys sitting directly under the prefix are listed on their own, the delimiter rolls up everything else
+            if has_keys:
+                shards.append({"Prefix": prefix, "Delimiter": "/"})
+            next_level += prefixes
+        if depth == 0 and not next_level:
+            # Flat keyspace, nothing to split on: fall back to key ranges
+            return split_key_range(args.prefix)
+        level = next_level
+        if not level or len(shards) + len(level) >= args.listing_workers:
+            break
+    return shards + [{"Prefix": prefix} for prefix in level]
+
+def in_shard(shard, key):
+    if "KeyMarker" in shard and key <= shard["KeyMarker"]:
+        return False
+    if "EndKey" in shard and key > shard["EndKey"]:
+        return False
+    # Keys rolled up by the delimiter belong to the shards of the deeper prefixes
+    if "Delimiter" in shard and shard["Delimiter"] in key[len(shard["Prefix"]):]:
+        return False
+    return True
+
+class Version:
+    # The fields of a listed version used by the restore, without the rest of the listing response. Fields
+    # are read like the ones of the listing dicts, and dict(version, ...) gives a dict with extra fields
+    __slots__ = ("Key", "VersionId", "LastModified", "Size", "StorageClass", "ETag", "IsLatest")
+
+    def __init__(self, key, version_id, last_modified, size=None, storage_class=None, etag=None, is_latest=None):
+        # Versions of the same key share the key string, and all the versions share the few storage classes
+        self.Key = sys.intern(key)
+        self.VersionId = version_id
+        self.LastModified = last_modified
+        self.Size = size
+        self.StorageClass = sys.intern(storage_class) if storage_class is not None else None
+        self.ETag = etag
+        # Only known from a live listing, versions read back from the index or a journal don't have it
+        self.IsLatest = is_latest
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        return name in self.__slots__
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def keys(self):
+        return self.__slots__
+
+def compact_obj(entry):
+    return Version(entry["Key"], entry["VersionId"], entry["LastModified"], entry.get("Size"), entry.get("StorageClass"), entry.get("ETag"), entry.get("IsLatest"))
+
+def parse_shard(value):
+    try:
+        shard_index, shard_count = (int(number) for number in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected INDEX/COUNT, like 0/4")
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise argparse.ArgumentTypeError("INDEX has to be between 0 and COUNT - 1")
+    return shard_index, shard_count
+
+def load_shard_bounds(path):
+    # One boundary key per line, the shard i owns the keys in (bound i - 1, bound i]
+    global shard_bounds
+    with open(path) as bounds_file:
+        shard_bounds = [line.rstrip("\n") for line in bounds_file if line.rstrip("\n")]
+    if len(shard_bounds) != args.shard[1] - 1 or shard_bounds != sorted(shard_bounds):
+        print("Shard bounds %s should hold %d sorted keys, exiting ..." % (path, args.shard[1] - 1), file=sys.stderr)
+        sys.exit(1)
+
+def shard_key_range():
+    shard_index, shard_count = args.shard
+    return shard_bounds[shard_index - 1] if shard_index > 0 else None, shard_bounds[shard_index] if shard_index < shard_count - 1 else None
+
+def owns_key(key):
+    # Every version of a key goes to the same shard, which resolves the key on its own
+    if args.shard is None:
+        return True
+    if shard_bounds is not None:
+        lower, upper = shard_key_range()
+        return (lower is None or key > lower) and (upper is None or key <= upper)
+    return zlib.crc32(key.encode()) % args.shard[1] == args.shard[0]
+
+def owned_page(page):
+    if args.shard is None:
+        return page
+    return dict(page, Versions=[obj for obj in page.get("Versions", []) if owns_key(obj["Key"])],
+                DeleteMarkers=[obj for obj in page.get("DeleteMarkers", []) if owns_key(obj["Key"])])
+
+def restrict_shard(shard, lower, upper):
+    # Narrows a listing shard to the key range of the restore shard, or drops it when they don't overlap
+    shard = dict(shard)
+    if lower is not None and shard.get("KeyMarker", "") < lower:
+        shard["KeyMarker"] = lower
+    if upper is not None and ("EndKey" not in shard or shard["EndKey"] > upper):
+        shard["EndKey"] = upper
+    if "KeyMarker" in shard and "EndKey" in shard and shard["KeyMarker"] >= shard["EndKey"]:
+        return None
+    # All the keys under the prefix are after the end of the range, or before its start
+    if "EndKey" in shard and shard["EndKey"] < shard["Prefix"]:
+        return None
+    if "KeyMarker" in shard and shard["KeyMarker"][:len(shard["Prefix"])] > shard["Prefix"]:
+        return None
+    return shard
+
+def open_index(path):
+    global index
+    index = sqlite3.connect(path, check_same_thread=False)
+    index.executescript(INDEX_SCHEMA)
+
+def indexed_listing():
+    # A listing of a parent prefix holds all the versions under args.prefix as well
+    for prefix, generation in index.execute("SELECT prefix, generation FROM listings WHERE bucket = ?", (args.bucket,)):
+        if args.prefix.startswith(prefix):
+            return generation
+    return None
+
+def next_index_generation():
+    return index.execute("SELECT COALESCE(MAX(generation), 0) + 1 FROM listings").fetchone()[0]
+
+def index_page(page, positions, generation):
+    rows = []
+    for is_delete_marker, entries in ((0, page.get("Versions", [])), (1, page.get("DeleteMarkers", []))):
+        for obj in entries:
+            # Versions of the same key keep the listing order (newest first) even when they share LastModified
+            last_key, position = positions.get(is_delete_marker, ("", -1))
+            position = position + 1 if obj["Key"] == last_key else 0
+            positions[is_delete_marker] = (obj["Key"], position)
+            rows.append((args.bucket, obj["Key"], obj["VersionId"], is_delete_marker, position, obj["LastModified"].isoformat(),
+                         obj.get("Size"), obj.get("StorageClass"), obj.get("ETag"), generation))
+    with index_lock:
+        index.executemany("INSERT OR REPLACE INTO versions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        index.commit()
+
+def record_listing(generation):
+    with index_lock:
+        # Versions which have not been listed again were deleted from the bucket in the meantime
+        index.execute("DELETE FROM versions WHERE bucket = ? AND key >= ? AND substr(key, 1, ?) = ? AND generation < ?",
+                      (args.bucket, args.prefix, len(args.prefix), args.prefix, generation))
+        index.execute("INSERT OR REPLACE INTO listings VALUES (?, ?, ?)", (args.bucket, args.prefix, generation))
+        index.commit()
+
+def obj_from_row(row):
+    return Version(row[0], row[1], datetime.fromisoformat(row[2]), row[3], row[4], row[5])
+
+def index_pages(shard):
+    # Pages are rebuilt like the list_object_versions ones: sorted by key and then newest first, with
+    # every delete marker up to the last key of the page. Only the keys of the shard are read back
+    prefix = shard["Prefix"]
+    query = "SELECT key, version_id, last_modified, size, storage_class, etag FROM versions " \
+            "WHERE bucket = ? AND is_delete_marker = ? AND key >= ? AND substr(key, 1, ?) = ?"
+    params = [prefix, len(prefix), prefix]
+    if "KeyMarker" in shard:
+        query += " AND key > ?"
+        params.append(shard["KeyMarker"])
+    if "EndKey" in shard:
+        query += " AND key <= ?"
+        params.append(shard["EndKey"])
+    query += " ORDER BY key, position, last_modified DESC"
+    versions = index.execute(query, [args.bucket, 0] + params)
+    deletemarkers = index.execute(query, [args.bucket, 1] + params)
+    dmarker = deletemarkers.fetchone()
+    while True:
+        rows = versions.fetchmany(INDEX_PAGE_SIZE)
+        if not rows:
+            return
+        page = {"Versions": [obj_from_row(row) for row in rows if in_shard(shard, row[0])], "DeleteMarkers": []}
+        while dmarker is not None and dmarker[0] <= rows[-1][0]:
+            if in_shard(shard, dmarker[0]):
+                page["DeleteMarkers"].append(obj_from_row(dmarker))
+            dmarker = deletemarkers.fetchone()
+        yield page
+
+def load_inventory(manifest_path, generation):
+    # Inventory files are in no particular order: their versions go through the index, which gives them
+    # back sorted like a listing
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get("sourceBucket", args.bucket) != args.bucket:
+        print("Inventory %s is a report of bucket %s, exiting ..." % (manifest_path, manifest["sourceBucket"]), file=sys.stderr)
+        sys.exit(1)
+    if manifest["fileFormat"] == "CSV" and "VersionId" not in manifest["fileSchema"]:
+        print("Inventory %s only reports the current versions, exiting ..." % manifest_path, file=sys.stderr)
+        sys.exit(1)
+    rows = []
+    for data_file in manifest["files"]:
+        for entry in inventory_entries(manifest, find_inventory_file(manifest_path, data_file["key"])):
+            if entry["Bucket"] != args.bucket or not entry["Key"].startswith(args.prefix):
+                continue
+            # Inventories have no listing order, versions of a key are ordered by LastModified instead
+            rows.append((args.bucket, entry["Key"], entry["VersionId"], entry["IsDeleteMarker"], 0, entry["LastModified"].isoformat(),
+                         entry["Size"], entry["StorageClass"], entry["ETag"], generation))
+            if len(rows) == INVENTORY_BATCH_SIZE:
+                insert_inventory(rows)
+                rows = []
+    insert_inventory(rows)
+    record_listing(generation)
+
+def insert_inventory(rows):
+    with index_lock:
+        index.executemany("INSERT OR REPLACE INTO versions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        index.commit()
+
+def find_inventory_file(manifest_path, key):
+    # Data files are looked up by their key next to the manifest, or in the data folder of a synced inventory
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    for path in (os.path.join(manifest_dir, key), os.path.join(manifest_dir, "data", os.path.basename(key)),
+                 os.path.join(os.path.dirname(manifest_dir), "data", os.path.basename(key))):
+        if os.path.exists(path):
+            return path
+    print("Inventory file %s not found, exiting ..." % key, file=sys.stderr)
+    sys.exit(1)
+
+def inventory_entries(manifest, path):
+    if manifest["fileFormat"] == "CSV":
+        columns = [column.strip() for column in manifest["fileSchema"].split(",")]
+        with gzip.open(path, "rt", newline="") as data_file:
+            for row in csv.reader(data_file):
+                entry = dict(zip(columns, row))
+                # Keys are URL encoded in CSV inventories
+                entry["Key"] = urllib.parse.unquote_plus(entry["Key"])
+                yield inventory_entry(entry)
+        return
+
+    # pyarrow is only needed by ORC and Parquet inventories
+    try:
+        import pyarrow.orc, pyarrow.parquet
+    except ImportError:
+        print("%s inventories need pyarrow, install it with: pip install pyarrow" % manifest["fileFormat"], file=sys.stderr)
+        sys.exit(1)
+    if manifest["fileFormat"] == "ORC":
+        orc_file = pyarrow.orc.ORCFile(path)
+        columns = [column for column in INVENTORY_COLUMNS.values() if column in orc_file.schema.names]
+        batches = (orc_file.read_stripe(stripe, columns=columns) for stripe in range(orc_file.nstripes))
+    else:
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        columns = [column for column in INVENTORY_COLUMNS.values() if column in parquet_file.schema_arrow.names]
+        batches = parquet_file.iter_batches(columns=columns)
+    for batch in batches:
+        for row in batch.to_pylist():
+            yield inventory_entry({name: row.get(column) for name, column in INVENTORY_COLUMNS.items()})
+
+def inventory_entry(entry):
+    # CSV values are all strings, ORC and Parquet ones are typed
+    last_modified = entry["LastModifiedDate"]
+    if isinstance(last_modified, str):
+        last_modified = parse(last_modified)
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    is_delete_marker = entry.get("IsDeleteMarker") in (True, "true")
+    return {
+        "Bucket": entry["Bucket"],
+        "Key": entry["Key"],
+        # Versions written before versioning was enabled have an empty version in the inventory
+        "VersionId": entry.get("VersionId") or "null",
+        "IsDeleteMarker": int(is_delete_marker),
+        "LastModified": last_modified,
+        "Size": None if is_delete_marker or entry.get("Size") in (None, "") else int(entry["Size"]),
+        "StorageClass": None if is_delete_marker else entry.get("StorageClass") or None,
+        # Listings quote the ETags, inventories don't
+        "ETag": '"%s"' % entry["ETag"] if entry.get("ETag") else None,
+    }
+
+def list_shard(shard, generation, position):
+    if generation is None:
+        yield from index_pages(shard)
+        return
+    positions = {}
+    for page in list_bucket_shard(shard, position):
+        if index is not None:
+            index_page(page, positions, generation)
+        yield page
+
+def list_bucket_shard(shard, position):
+    paginator = client.get_paginator('list_object_versions')
+    params = {name: value for name, value in shard.items() if name != "EndKey"}
+    # A resumed listing starts right after the last page of the checkpoint
+    if position is not None:
+        params["KeyMarker"] = position["KeyMarker"]
+        params["VersionIdMarker"] = position["VersionIdMarker"]
+    for page in paginator.paginate(Bucket=args.bucket, **params):
+        versions = page.get("Versions", [])
+        deletemarkers = page.get("DeleteMarkers", [])
+        last_key = max([entries[-1]["Key"] for entries in (versions, deletemarkers) if entries], default="")
+        truncated = page.get("IsTruncated", False) and not ("EndKey" in shard and last_key > shard["EndKey"])
+        # Only the compact versions are kept, the response itself is dropped right away
+        yield {
+            "Versions": [compact_obj(obj) for obj in versions if in_shard(shard, obj["Key"])],
+            "DeleteMarkers": [compact_obj(obj) for obj in deletemarkers if in_shard(shard, obj["Key"])],
+            "IsTruncated": truncated,
+            "NextKeyMarker": page.get("NextKeyMarker"),
+            "NextVersionIdMarker": page.get("NextVersionIdMarker"),
+        }
+        if not truncated:
+            return
+
+def journal(entry, sync=False):
+    with checkpoint_lock:
+        checkpoint.write(json.dumps(entry) + "\n")
+        checkpoint.flush()
+        if sync:
+            os.fsync(checkpoint.fileno())
+
+def obj_to_json(obj):
+    return {"Key": obj["Key"], "VersionId": obj["VersionId"], "LastModified": obj["LastModified"].isoformat(), "Size": obj.get("Size"),
+            "StorageClass": obj.get("StorageClass"), "ETag": obj.get("ETag")}
+
+def obj_from_json(entry):
+    return Version(entry["Key"], entry["VersionId"], datetime.fromisoformat(entry["LastModified"]), entry.get("Size"), entry.get("StorageClass"), entry.get("ETag"))
+
+def open_checkpoint(path, header):
+    global checkpoint
+    checkpoint = open(path, "w")
+    journal(header, sync=True)
+
+def load_checkpoint(path, header):
+    global checkpoint
+    resume = {"Header": {}, "Positions": {}, "Deletes": DeleteSet(), "Deleted": set()}
+    with open(path) as journal_file:
+        for line in journal_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line may have been cut by a crash
+                break
+            if "Shards" in entry:
+                resume["Header"] = entry
+            elif "Shard" in entry:
+                resume["Positions"][entry["Shard"]] = entry
+            elif "Done" in entry:
+                done_objs.add(tuple(entry["Done"]))
+            elif "Delete" in entry:
+                resume["Deletes"][entry["Delete"]["Key"]] = obj_from_json(entry["Delete"])
+            elif "Keep" in entry:
+                resume["Deletes"].pop(entry["Keep"], None)
+            elif "Deleted" in entry:
+                resume["Deleted"].add(entry["Deleted"])
+    if not args.timestamp:
+        # Without a timestamp the restore goes on at the point in time of the interrupted one
+        header = dict(header, Timestamps=resume["Header"].get("Timestamps"))
+    if {name: value for name, value in resume["Header"].items() if name != "Shards"} != header:
+        print("Checkpoint %s doesn't match this restore, exiting ..." % path, file=sys.stderr)
+        sys.exit(1)
+    checkpoint = open(path, "a")
+    return resume
+
+def open_page(shard_index):
+    page = {"Shard": shard_index, "Pending": 0, "Closed": False, "Failed": False, "Position": None}
+    with checkpoint_lock:
+        checkpoint_pages.setdefault(shard_index, collections.deque()).append(page)
+    return page
+
+def page_position(page, found, pits):
+    # Pages read back from the index have no markers to resume from, they are just read again
+    if "IsTruncated" not in page:
+        return None
+    return {
+        "KeyMarker": page.get("NextKeyMarker"),
+        "VersionIdMarker": page.get("NextVersionIdMarker"),
+        "Done": not page["IsTruncated"],
+        "Found": found,
+        "Pits": [{"LastKey": pit["LastObj"]["Key"], "DeleteMarkers": [obj_to_json(dmarker) for dmarker in pit["PreviousDeleteMarkers"] if dmarker["Key"]]} for pit in pits],
+    }
+
+def close_page(item):
+    with checkpoint_lock:
+        item["Page"]["Closed"] = True
+        item["Page"]["Position"] = item["Checkpoint"]
+        advance_checkpoint(item["Page"]["Shard"])
+
+def track_obj(obj):
+    if not isinstance(obj, dict) or "Page" not in obj:
+        return
+    with checkpoint_lock:
+        obj["Page"]["Pending"] += 1
+
+def untrack_obj(obj):
+    if not isinstance(obj, dict) or "Page" not in obj:
+        return
+    with checkpoint_lock:
+        obj["Page"]["Pending"] -= 1
+
+def release_obj(obj, failed):
+    if not isinstance(obj, dict) or "Page" not in obj:
+        return
+    with checkpoint_lock:
+        if failed:
+            # A failed object stops the checkpoint, so that a resumed restore retries it
+            obj["Page"]["Failed"] = True
+        else:
+            journal({"Done": [obj["Key"], obj["VersionId"]]})
+        obj["Page"]["Pending"] -= 1
+        advance_checkpoint(obj["Page"]["Shard"])
+
+def advance_checkpoint(shard_index):
+    # The checkpoint moves past a page once the page and all the previous ones of the shard are done
+    pages = checkpoint_pages[shard_index]
+    position = None
+    while pages and pages[0]["Closed"] and not pages[0]["Pending"] and not pages[0]["Failed"]:
+        position = pages.popleft()["Position"] or position
+    if position is not None:
+        journal(dict(position, Shard=shard_index), sync=True)
+
+class DeleteSet:
+    # Versions to delete by key once the restore is done. A restore far back in time can have most of the
+    # bucket to delete, so past DELETE_SPILL_THRESHOLD keys they are moved to a temporary SQLite database
+    def __init__(self):
+        self.objs = {}
+        self.db = None
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            if self.db is None:
+                return key in self.objs
+            return self.db.execute("SELECT 1 FROM deletes WHERE key = ?", (key,)).fetchone() is not None
+
+    def __setitem__(self, key, obj):
+        with self.lock:
+            if self.db is None:
+                self.objs[key] = obj
+                if len(self.objs) > DELETE_SPILL_THRESHOLD:
+                    self.spill()
+                return
+            self.db.execute("INSERT OR REPLACE INTO deletes VALUES (?, ?)", (key, json.dumps(obj_to_json(obj))))
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if self.db is None:
+                return self.objs.pop(key, default)
+            row = self.db.execute("SELECT obj FROM deletes WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return default
+            self.db.execute("DELETE FROM deletes WHERE key = ?", (key,))
+            return obj_from_json(json.loads(row[0]))
+
+    def __len__(self):
+        with self.lock:
+            if self.db is None:
+                return len(self.objs)
+            return self.db.execute("SELECT COUNT(*) FROM deletes").fetchone()[0]
+
+    def values(self):
+        with self.lock:
+            objs = list(self.objs.values()) if self.db is None else None
+        if objs is not None:
+            yield from objs
+            return
+        # Read back a batch at a time, so that the spilled versions are never all in memory again
+        last_key = ""
+        while True:
+            with self.lock:
+                rows = self.db.execute("SELECT key, obj FROM deletes WHERE key > ? ORDER BY key LIMIT ?", (last_key, DELETE_BATCH_SIZE)).fetchall()
+            if not rows:
+                return
+            for key, entry in rows:
+                yield obj_from_json(json.loads(entry))
+            last_key = rows[-1][0]
+
+    def spill(self):
+        # An empty file name opens a private database on disk, removed as soon as it's closed
+        self.db = sqlite3.connect("", check_same_thread=False)
+        self.db.execute("CREATE TABLE deletes (key TEXT PRIMARY KEY, obj TEXT NOT NULL)")
+        self.db.executemany("INSERT INTO deletes VALUES (?, ?)", ((key, json.dumps(obj_to_json(obj))) for key, obj in self.objs.items()))
+        self.objs = {}
+
+def write_plan(obj, action, plan_file=None):
+    # The source bucket goes with every action, --apply runs them against the bucket given to it
+    entry = dict(obj_to_json(obj), Action=action, Bucket=args.bucket)
+    if "Snapshots" in obj:
+        entry["Snapshots"] = obj["Snapshots"]
+    with plan_lock:
+        (plan if plan_file is None else plan_file).write(json.dumps(entry) + "\n")
+
+def obj_from_plan(entry):
+    obj = dict(obj_from_json(entry), Action=entry["Action"])
+    if "Snapshots" in entry:
+        obj["Snapshots"] = entry["Snapshots"]
+    return obj
+
+def plan_obj(obj, obj_needs_be_deleted):
+    # The version is kept from the delete like by a real restore, which would have copied it
+    if args.dest_bucket is not None and obj_needs_be_deleted is not None:
+        keep_from_delete(obj_needs_be_deleted, obj)
+    if obj["StorageClass"] in GLACIER_STORAGE_CLASSES:
+        action = "glacier"
+    elif args.dest_bucket is not None:
+        action = "copy"
+    else:
+        action = "download"
+    write_plan(obj, action)
+    print_obj(obj, optional_message=action)
+    return True
+
+def replan_obj(obj):
+    # The actions failed by --apply make up the plan of what is left to do
+    if plan is not None and "Action" in obj:
+        write_plan(obj, obj["Action"])
+
+def record_verify(obj):
+    # Restored versions are written down like plan actions, so that the mismatched ones make up a plan of their own
+    if verify_file is None or obj["Key"].endswith("/"):
+        return
+    write_plan(obj, "copy" if args.dest_bucket is not None else "download", verify_file)
+
+def verify_restore(dest_prefixes):
+    # Local files are hashed by a pool of processes, one per core. Copies in a bucket are checked against
+    # a single listing of the destination, and by their checksums when the ETags are multipart
+    global verify_pool
+    start = time.monotonic()
+    retry = gzip.open(args.verify_out, "wt") if args.verify_out else None
+    if args.verify == "checksum" and not has_crc32c():
+        print("Versions with a CRC32C checksum are verified by ETag, install crc32c to verify their checksum: pip install crc32c", file=sys.stderr)
+    try:
+        if args.dest_bucket is not None:
+            list_dest_objs(dest_prefixes)
+        else:
+            verify_pool = concurrent.futures.ProcessPoolExecutor()
+        # Nothing is recorded anymore once the restore is over, the versions are read back one by one
+        verify_file.seek(0)
+        for line in verify_file:
+            obj = obj_from_plan(json.loads(line))
+            if not submit(verify_local_obj if args.dest_bucket is None else verify_remote_obj, obj, report=lambda future: report_verify(future, retry)):
+                return False
+        wait_futures()
+    finally:
+        if verify_pool is not None:
+            verify_pool.shutdown()
+        if retry is not None:
+            retry.close()
+        time_phase("verify", start)
+    return True
+
+def report_verify(future, retry):
+    obj = settle_future(future)
+    if obj is None:
+        return
+    try:
+        problem = future.result()
+    except Exception as ex:
+        problem = "not verified, %s" % ex
+    report_verified(obj, problem, retry)
+
+def report_verified(obj, problem, retry):
+    with concurrency_cond:
+        concurrency["Verified" if problem is None else "Mismatched"] += 1
+    if problem is None:
+        return
+    print_error(obj, "verification failed: %s" % problem)
+    if retry is not None:
+        write_plan(obj, obj["Action"], retry)
+
+def verify_local_obj(obj):
+    algorithm, part_size, expected = expected_checksum(obj)
+    inodes = set()
+    for path in get_paths(obj):
+        stat = os.stat(path)
+        if stat.st_size != obj["Size"]:
+            return "size %d instead of %d" % (stat.st_size, obj["Size"])
+        # Snapshots of the same version linked to the first file are hashed once
+        if stat.st_ino in inodes or expected is None:
+            continue
+        inodes.add(stat.st_ino)
+        digest = verify_pool.submit(hash_file, os.path.abspath(path), algorithm, part_size).result()
+        if digest != expected:
+            return "%s %s instead of %s" % (algorithm, digest, expected)
+    return None
+
+def verify_remote_obj(obj):
+    for key in get_keys(obj):
+        if key not in dest_objs:
+            return "missing at the destination"
+        etag, size = dest_objs[key]
+        if size != obj["Size"]:
+            return "size %d instead of %d" % (size, obj["Size"])
+        if "-" not in obj["ETag"] and "-" not in etag:
+            if etag != obj["ETag"]:
+                return "ETag %s instead of %s" % (etag, obj["ETag"])
+            continue
+        # Multipart ETags depend on the part size of each upload or copy, only the checksums tell
+        same = compare_checksums(obj, key)
+        if same is None:
+            return "multipart copy without a full object checksum in common with the version"
+        if not same:
+            return "checksum of %s differs from the version" % key
+    return None
+
+def expected_checksum(obj):
+    # ETags of multipart uploads, and composite checksums, are digests of the digests of the parts: the part size
+    # is the size of the first part
+    if args.verify == "checksum":
+        head = client.head_object(Bucket=args.bucket, Key=obj["Key"], VersionId=obj["VersionId"], ChecksumMode="ENABLED")
+        for field, algorithm in VERIFY_CHECKSUMS:
+            if field in head and (algorithm != "crc32c" or has_crc32c()):
+                return algorithm, first_part_size(obj) if "-" in head[field] else None, head[field]
+    etag = (obj.get("ETag") or "").strip('"')
+    if not etag:
+        return None, None, None
+    return "md5", first_part_size(obj) if "-" in etag else None, etag
+
+def first_part_size(obj):
+    return client.head_object(Bucket=args.bucket, Key=obj["Key"], VersionId=obj["VersionId"], PartNumber=1)["ContentLength"]
+
+def has_crc32c():
+    try:
+        import crc32c
+    except ImportError:
+        return False
+    return True
+
+def hash_file(path, algorithm, part_size):
+    # Runs in the verification processes: the file is mapped in memory and hashed without being copied
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        try:
+            with memoryview(data) as view:
+                if part_size is None:
+                    return encode_checksum(algorithm, checksum(algorithm, view))
+                parts = [checksum(algorithm, view[start:start + part_size]) for start in range(0, size, part_size)]
+        finally:
+            if size:
+                data.close()
+    return "%s-%d" % (encode_checksum(algorithm, checksum(algorithm, b"".join(parts))), len(parts))
+
+def checksum(algorithm, data):
+    if algorithm == "crc32":
+        return zlib.crc32(data).to_bytes(4, "big")
+    if algorithm == "crc32c":
+        import crc32c
+        return crc32c.crc32c(data).to_bytes(4, "big")
+    return hashlib.new(algorithm, data).digest()
+
+def encode_checksum(algorithm, digest):
+    # ETags are hexadecimal MD5 digests, the additional checksums are in base64
+    return digest.hex() if algorithm == "md5" else base64.b64encode(digest).decode()
+
+def mark_for_delete(obj_needs_be_deleted, obj):
+    if checkpoint is not None and obj["Key"] not in obj_needs_be_deleted:
+        journal({"Delete": obj_to_json(obj)})
+    obj_needs_be_deleted[obj["Key"]] = obj
+
+def keep_from_delete(obj_needs_be_deleted, obj):
+    if obj_needs_be_deleted.pop(obj["Key"], None) is not None and checkpoint is not None:
+        journal({"Keep": obj["Key"]})
+
+def enqueue(work, stop, item):
+    try:
+        work.put_nowait(item)
+        return True
+    except queue.Full:
+        pass
+    # Time the listing waits for the transfers to drain the queue
+    start = time.monotonic()
+    try:
+        while not stop.is_set():
+            try:
+                work.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    finally:
+        time_phase("queue_wait", start)
+
+def new_pit(pit_end_date, snapshot):
+    # Delete markers are consumed from the front and carried over between pages as deques, so that the
+    # merge with the versions stays linear however many markers pile up
+    return {"PitEndDate": pit_end_date, "Snapshot": snapshot, "LastObj": {"Key": ""}, "DeleteMarkers": collections.deque(), "PreviousDeleteMarkers": collections.deque()}
+
+def start_page(pit, deletemarkers):
+    # Some deletemarkers may come from the previous page: add them now
+    pit["DeleteMarkers"] = pit["PreviousDeleteMarkers"]
+    pit["DeleteMarkers"].extend(deletemarkers)
+    # And since they have been added, we remove them from the overflow list
+    pit["PreviousDeleteMarkers"] = collections.deque()
+    pit["Dmarker"] = {"Key":""}
+
+def end_page(pit):
+    # The last dmarker may belong to the next version (if dmarker["Key"] != obj["Key"] ), keep it,
+    # and all following may too, if any, so carry them as well
+    pit["DeleteMarkers"].appendleft(pit["Dmarker"])
+    pit["PreviousDeleteMarkers"] = pit["DeleteMarkers"]
+    pit["DeleteMarkers"] = collections.deque()
+
+def is_pit_version(pit, obj, pit_start_date, obj_needs_be_deleted):
+    pit_end_date = pit["PitEndDate"]
+    deletemarkers = pit["DeleteMarkers"]
+    if pit["LastObj"]["Key"] == obj["Key"]:
+        # We've had a newer version or a delete of this key
+        return False
+
+    version_date = obj["LastModified"]
+
+    if version_date > pit_end_date or version_date < pit_start_date:
+        if pit_start_date == datetime.fromtimestamp(0, timezone.utc) and obj_needs_be_deleted is not None:
+            mark_for_delete(obj_needs_be_deleted, obj)
+        return False
+
+    # Dont go farther in the deletemarkers list than the current key, or else we risk consuming desync delete markers of the next page
+    # (both versions and deletemarkers list are sorted in alphabetical order of the key, and then in reverse time order for each key)
+    dmarker = pit["Dmarker"]
+    while deletemarkers and (dmarker["Key"] < obj["Key"] or (dmarker["Key"] == obj["Key"] and dmarker["LastModified"] > pit_end_date)):
+        dmarker = deletemarkers.popleft()
+    pit["Dmarker"] = dmarker
+
+    #skip dmarker if it's latest than pit_end_date
+    if dmarker["Key"] == obj["Key"] and dmarker["LastModified"] > obj["LastModified"] and dmarker["LastModified"] <= pit_end_date:
+        # The most recent operation on this key was a delete
+        pit["LastObj"] = dmarker
+        return False
+
+    # This version needs to be restored..
+    pit["LastObj"] = obj
+    return True
+
+def resolve_page(pits, page, pit_start_date, obj_needs_be_deleted):
+    for pit in pits:
+        start_page(pit, page.get("DeleteMarkers", []))
+    for obj in page.get("Versions", []):
+        chosen = [pit["Snapshot"] for pit in pits if is_pit_version(pit, obj, pit_start_date, obj_needs_be_deleted)]
+        if not chosen:
+            continue
+        # A version shared by several snapshots is restored once and transferred once
+        yield dict(obj, Snapshots=chosen) if len(pits) > 1 else obj
+    for pit in pits:
+        end_page(pit)
+
+def resolve_shard(shard_index, shard, position, generation, work, stop, obj_needs_be_deleted, pit_start_date, pit_end_dates):
+    # Every point in time walks the same pages with its own delete markers reconciliation
+    pits = [new_pit(pit_end_date, snapshot_label(pit_end_date)) for pit_end_date in pit_end_dates]
+    found = 0
+    if position is not None:
+        if position["Done"]:
+            enqueue(work, stop, None)
+            return position["Found"]
+        found = position["Found"]
+        for pit, state in zip(pits, position["Pits"]):
+            pit["LastObj"] = {"Key": state["LastKey"]}
+            pit["PreviousDeleteMarkers"] = collections.deque(obj_from_json(dmarker) for dmarker in state["DeleteMarkers"])
+    # Delete markers can get desynchronized with the versions markers in the pagination system below.
+    # To avoid this, we will push from page to page the desynchronized markers until they fall on the
+    # page they should (the one with the versioning markers for the same set of files)
+    try:
+        for page in timed_pages(list_shard(shard, generation, position), "listing"):
+            # Keys of the other shards are dropped before anything is resolved or queued
+            start = time.monotonic()
+            page = owned_page(page)
+            versions = page.get("Versions", [])
+            found += len(versions)
+            count_listed(len(versions))
+            checkpoint_page = open_page(shard_index) if checkpoint is not None else None
+            # Resolved apart from the queueing, so that the waits for the queue aren't counted in the resolution
+            objs = list(resolve_page(pits, page, pit_start_date, obj_needs_be_deleted))
+            time_phase("resolve", start)
+            for obj in objs:
+                if checkpoint_page is not None:
+                    obj = dict(obj, Page=checkpoint_page)
+                if not enqueue(work, stop, obj):
+                    return found
+            # The page is closed once all its versions have gone through the queue
+            if checkpoint_page is not None and not enqueue(work, stop, {"Checkpoint": page_position(page, found, pits), "Page": checkpoint_page}):
+                return found
+    finally:
+        enqueue(work, stop, None)
+    return found
+
+def restore_obj(obj, obj_needs_be_deleted):
+    # Already restored before the restart of a resumed restore
+    if (obj["Key"], obj["VersionId"]) in done_objs:
+        if args.dest_bucket is not None and obj_needs_be_deleted is not None:
+            keep_from_delete(obj_needs_be_deleted, obj)
+        return True
+
+    # Already at the destination with the same content, left as it is
+    if args.skip_existing and not obj["Key"].endswith("/") and is_restored(obj):
+        if args.dest_bucket is not None and obj_needs_be_deleted is not None:
+            keep_from_delete(obj_needs_be_deleted, obj)
+        if args.verbose:
+            print_obj(obj, optional_message='unchanged')
+        record_verify(obj)
+        return True
+
+    # A planned restore records what it would transfer instead of transferring it
+    if plan is not None and not args.apply:
+        return plan_obj(obj, obj_needs_be_deleted)
+
+    if handled_by_glacier(obj, obj_needs_be_deleted):
+        return True
+
+    if args.dest_bucket is not None:
+        if obj_needs_be_deleted is not None:
+            keep_from_delete(obj_needs_be_deleted, obj)
+        return handled_by_copy(obj)
+
+    return handled_by_standard(obj)
+
+def no_versions():
+    # A shard can own none of the keys of a small prefix, or have a key range without keys: it's done, and its
+    # empty summary is merged with the others
+    if args.shard:
+        print("No versions in shard %d/%d" % args.shard, file=sys.stderr)
+        return
+    print("No versions matching criteria, exiting ...", file=sys.stderr)
+    sys.exit(1)
+
+def snapshot_label(pit_end_date):
+    return pit_end_date.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+def get_pit_end_dates():
+    if not args.timestamp:
+        return [datetime.now(timezone.utc)]
+    pit_end_dates = [parse(timestamp) for timestamp in args.timestamp]
+    if args.timestamp_step:
+        pit_end_date, last_date = pit_end_dates
+        pit_end_dates = []
+        while pit_end_date <= last_date:
+            pit_end_dates.append(pit_end_date)
+            pit_end_date += timedelta(seconds=args.timestamp_step)
+    # Timestamps falling in the same second would restore the same snapshot
+    labels = {}
+    for pit_end_date in pit_end_dates:
+        labels.setdefault(snapshot_label(pit_end_date), pit_end_date)
+    return list(labels.values())
+
+def parse_size(size):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if size[-1:].upper() in units:
+        return int(float(size[:-1]) * units[size[-1:].upper()])
+    return int(size)
+
+def import_boto3():
+    global boto3, botocore, Config, TransferConfig, create_transfer_manager
+    if boto3 is not None:
+        return
+    import boto3, botocore.exceptions
+    from boto3.s3.transfer import TransferConfig, create_transfer_manager
+    from botocore.config import Config
+
+def parse(timestamp):
+    # dateutil is only imported once a timestamp is parsed
+    from dateutil.parser import parse as parse_timestamp
+    return parse_timestamp(timestamp)
+
+def open_transfers():
+    # The client, the transfer manager and the workers are shared by all the restores of a session
+    import_boto3()
     global client
-    client = boto3.client('s3', endpoint_url=args.endpoint_url, verify=False)
+    # Every transfer worker can have max_concurrency requests in flight, plus one listing request per listing worker
+    max_pool_connections = args.max_workers * args.max_concurrency + args.listing_workers
+    client = boto3.client('s3', endpoint_url=args.endpoint_url, verify=False, config=Config(max_pool_connections=max_pool_connections))
 
+    # A single transfer manager shared by downloads and copies, sized for all the workers at once
     global transfer
-    transfer = boto3.s3.transfer.S3Transfer(client)
+    transfer_config = TransferConfig(multipart_threshold=args.multipart_threshold, multipart_chunksize=args.multipart_chunksize,
+                                     max_concurrency=args.max_workers * args.max_concurrency, max_bandwidth=args.max_bandwidth)
+    transfer = create_transfer_manager(client, transfer_config)
+
+    global executor
+    executor = concurrent.futures.ThreadPoolExecutor(args.max_workers)
+
+    # Every S3 request of the client, including the ones of the transfer manager, is timed by operation
+    client.meta.events.register("before-call.s3", before_request)
+    client.meta.events.register("after-call.s3", after_request)
+    client.meta.events.register("after-call-error.s3", after_request)
+
+def start_transfers():
+    if client is None:
+        open_transfers()
+    global inflight
+    inflight = threading.BoundedSemaphore(args.max_workers * INFLIGHT_PER_WORKER)
+    # The adaptive limit starts low and grows up to max_workers running requests
+    init_concurrency(max(1, args.max_workers // 4) if args.adaptive else args.max_workers, args.max_workers)
+    init_metrics()
+    start_progress()
+
+def reset_restore():
+    # What a restore leaves in the globals, cleared before the next restore of a session
+    global dest_objs, glacier_state_file, checkpoint, index, shard_bounds, archive, archive_part, archive_seq, archive_next, work_queue
+    for state in (futures, unbounded_futures, done_objs, glacier_state, checkpoint_pages, prefix_backoff, dedup, archive_buffer):
+        state.clear()
+    del glacier_pending[:]
+    for state_file in (glacier_state_file, checkpoint, index):
+        if state_file is not None:
+            state_file.close()
+    dest_objs = glacier_state_file = checkpoint = index = shard_bounds = archive = work_queue = None
+    archive_part = archive_seq = archive_next = 0
+    interrupted.clear()
+
+def run_restore():
+    # Plans, archives and verification lists are written as streams, they are only complete once closed,
+    # an interrupted restore included. Returns whether the restore went through, it stops early once interrupted
+    global plan, verify_file, archive
+    import_boto3()
+    if args.plan_out:
+        plan = gzip.open(args.plan_out, "wt")
+    if args.archive and not args.dry_run:
+        open_archive()
+    # Restored versions waiting for their verification, kept on disk
+    if args.verify:
+        verify_file = tempfile.TemporaryFile("w+")
+    try:
+        if args.engine == "async":
+            return do_restore_async()
+        elif args.apply:
+            return do_apply()
+        else:
+            return do_restore()
+    finally:
+        # The reports of the transfers still in flight, after an interruption or an error, write to the outputs
+        if concurrency:
+            wait_futures()
+        progress_stop.set()
+        if plan is not None:
+            plan.close()
+            plan = None
+        if verify_file is not None:
+            verify_file.close()
+            verify_file = None
+        if archive is not None:
+            with archive_write_lock:
+                close_archive()
+            archive = None
+
+class RestoreError(Exception):
+    pass
+
+class RestoreSession:
+    # Library API, for the restores of many prefixes or points in time in a single process: they run one after the
+    # other and share the S3 client, the transfer manager and the workers. Options are the ones of the command line
+    # by their argparse name (sizes in bytes), those given to the session apply to all its restores:
+    #
+    #     with RestoreSession(max_workers=64) as session:
+    #         for prefix in prefixes:
+    #             summary = session.restore(bucket="my-bucket", prefix=prefix, timestamp="06-17-2016 23:59:50 +2", dest="restored")
+    #
+    # Restores return their summary, and raise RestoreError when the command line would have exited with an error.
+    # The restore state is held by the module: only one session restores at a time in a process
+
+    def __init__(self, **options):
+        global args
+        args = make_args(options)
+        if args.engine != "threads":
+            raise ValueError("a session shares the workers of the threads engine, --engine async can't be used")
+        self.options = options
+        open_transfers()
+
+    def restore(self, **options):
+        global args, executor
+        if client is None:
+            raise ValueError("the session is closed")
+        shared = [name for name in SESSION_OPTIONS if name in options]
+        if shared:
+            raise ValueError("%s can only be given to the session, its client and workers are already made" % ", ".join(shared))
+        args = make_args(dict(self.options, **options))
+        check_args(invalid_option)
+        # The workers of an interrupted restore are shut down, the next restore gets new ones
+        if interrupted.is_set():
+            executor = concurrent.futures.ThreadPoolExecutor(args.max_workers)
+        reset_restore()
+        cwd = os.getcwd()
+        try:
+            completed = run_restore()
+        except SystemExit as ex:
+            # The reason has already been printed, like on the command line
+            raise RestoreError("restore of s3://%s/%s failed with status %s" % (args.bucket, args.prefix, ex.code))
+        finally:
+            os.chdir(cwd)
+        if not completed:
+            raise RestoreError("restore of s3://%s/%s was interrupted" % (args.bucket, args.prefix))
+        return get_summary()
+
+    def close(self):
+        global client, transfer, executor
+        executor.shutdown()
+        transfer.shutdown()
+        client = transfer = executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def make_args(options):
+    namespace = build_parser().parse_args([])
+    for name, value in options.items():
+        if not hasattr(namespace, name):
+            raise TypeError("unknown option %s" % name)
+        # A single point in time can be given as a string
+        if name == "timestamp" and isinstance(value, str):
+            value = [value]
+        setattr(namespace, name, value)
+    return namespace
+
+def invalid_option(message):
+    raise ValueError(message)
+
+def do_restore():
+    if args.shard_bounds:
+        load_shard_bounds(args.shard_bounds)
+    pit_start_date = (parse(args.from_timestamp) if args.from_timestamp else datetime.fromtimestamp(0, timezone.utc))
+    pit_end_dates = get_pit_end_dates()
+    start_transfers()
     dest = args.dest
-    last_obj = {}
-    last_obj["Key"] = ""
 
     if args.debug: boto3.set_stream_logger('botocore')
 
-    global executor
-    executor = concurrent.futures.ThreadPoolExecutor(args.max_workers)
+    # Versions are read back from the index when it already holds a listing of the prefix, otherwise
+    # the bucket is listed and the index refreshed with a new generation of the listing
+    generation = None
+    if args.inventory:
+        # Without an index file the inventory is loaded in a temporary one
+        open_index(args.index or "")
+        load_inventory(args.inventory, next_index_generation())
+    elif args.index:
+        open_index(args.index)
+        if args.refresh_index or indexed_listing() is None:
+            generation = next_index_generation()
+    else:
+        generation = 0
+
+    # The journal goes on from where an interrupted restore stopped, or starts over
+    resume = None
+    if args.checkpoint:
+        checkpoint_path = os.path.abspath(args.checkpoint)
+        header = {"Bucket": args.bucket, "Prefix": args.prefix, "FromTimestamp": pit_start_date.isoformat(),
+                  "Timestamps": [pit_end_date.isoformat() for pit_end_date in pit_end_dates]}
+        if args.shard:
+            header["Shard"] = "%d/%d" % args.shard
+        if args.resume and os.path.exists(checkpoint_path):
+            resume = load_checkpoint(checkpoint_path, header)
+            pit_end_dates = [datetime.fromisoformat(pit_end_date) for pit_end_date in resume["Header"]["Timestamps"]]
+    # Known once a resumed restore has its points in time back from the journal
+    snapshots = len(pit_end_dates) > 1
+
+    # Opened after the move to the destination directory, so relative paths are taken before it
+    glacier_state_path = os.path.abspath(args.glacier_state) if args.glacier_state else None
 
     # Only create directories when s3 destination bucket option is missing
-    if args.dest_bucket is None and not args.dry_run:
+    if args.dest_bucket is None and not args.archive and not args.dry_run:
         if not os.path.exists(dest):
             os.makedirs(dest)
         os.chdir(dest)
 
-    paginator = client.get_paginator('list_object_versions')
-    obj_needs_be_deleted = {}
-    page_iterator = paginator.paginate(Bucket=args.bucket, Prefix=args.prefix)
-    # Delete markers can get desynchronized with the versions markers in the pagination system below.
-    # To avoid this, we will push from page to page the desynchronized markers until they fall on the
-    # page they should (the one with the versioning markers for the same set of files)
-    previous_deletemarkers = []
-    for page in page_iterator:
-        if not "Versions" in page:
-            print("No versions matching criteria, exiting ...", file=sys.stderr)
-            sys.exit(1)
-        versions = page["Versions"]
-        # Some deletemarkers may come from the previous page: add them now
-        deletemarkers = previous_deletemarkers + page.get("DeleteMarkers", [])
-        # And since they have been added, we remove them from the overflow list
-        previous_deletemarkers = []
-        dmarker = {"Key":""}
-        for obj in versions:
-            if last_obj["Key"] == obj["Key"]:
-                # We've had a newer version or a delete of this key
-                continue
+    dest_prefixes = get_keys({"Key": args.prefix, "Snapshots": [snapshot_label(pit_end_date) for pit_end_date in pit_end_dates]} if snapshots else {"Key": args.prefix})
+    if args.skip_existing and args.dest_bucket is not None:
+        list_dest_objs(dest_prefixes)
 
-            version_date = obj["LastModified"]
+    if args.glacier_state:
+        load_glacier_state(glacier_state_path)
 
-            if version_date > pit_end_date or version_date < pit_start_date:
-                if pit_start_date == datetime.fromtimestamp(0, timezone.utc):
-                    obj_needs_be_deleted[obj["Key"]] = obj
-                continue
+    # Snapshots never restore over the original keys, so nothing has to be deleted
+    obj_needs_be_deleted = DeleteSet() if not snapshots else None
+    if resume is not None and not snapshots:
+        obj_needs_be_deleted = resume["Deletes"]
+    # Shards are listed in parallel, each one resolving its own versions against its own delete markers,
+    # and all of them feed the versions to restore into the same bounded queue. Transfers are submitted
+    # as soon as versions are dequeued, so listing and transfers overlap; when the transfers lag behind
+    # the queue fills up and the listing waits.
+    global work_queue
+    work = work_queue = queue.Queue(args.queue_size)
+    stop = threading.Event()
+    with concurrent.futures.ThreadPoolExecutor(args.listing_workers) as listing_executor:
+        if resume is not None:
+            shards = resume["Header"]["Shards"]
+        else:
+            shards = discover_shards(listing_executor) if generation is not None else [{"Prefix": args.prefix}]
+            # With key ranges only the range of this shard is listed. The version index has to hold whole
+            # listings, so it's still filled with all the keys
+            if shard_bounds is not None and generation is not None and index is None:
+                shards = [shard for shard in (restrict_shard(shard, *shard_key_range()) for shard in shards) if shard is not None]
+            if args.checkpoint:
+                open_checkpoint(checkpoint_path, dict(header, Shards=shards))
+        listings = [listing_executor.submit(resolve_shard, shard_index, shard, resume["Positions"].get(shard_index) if resume is not None else None,
+                                            generation, work, stop, obj_needs_be_deleted, pit_start_date, pit_end_dates)
+                    for shard_index, shard in enumerate(shards)]
+        pending_shards = len(shards)
+        while pending_shards:
+            obj = work.get()
+            if obj is None:
+                pending_shards -= 1
+            elif "Checkpoint" in obj:
+                close_page(obj)
+            elif not restore_obj(obj, obj_needs_be_deleted):
+                stop.set()
+                return False
+        found = sum(listing.result() for listing in listings)
+    metrics["ListingDone"] = True
 
-            # Dont go farther in the deletemarkers list than the current key, or else we risk consuming desync delete markers of the next page
-            # (both versions and deletemarkers list are sorted in alphabetical order of the key, and then in reverse time order for each key)
-            while deletemarkers and (dmarker["Key"] < obj["Key"] or (dmarker["Key"] == obj["Key"] and dmarker["LastModified"] > pit_end_date)):
-                dmarker = deletemarkers.pop(0)
+    # A resumed listing has only seen the pages after the checkpoint
+    if index is not None and generation is not None and resume is None:
+        record_listing(generation)
 
-            #skip dmarker if it's latest than pit_end_date
-            if dmarker["Key"] == obj["Key"] and dmarker["LastModified"] > obj["LastModified"] and dmarker["LastModified"] <= pit_end_date:
-                # The most recent operation on this key was a delete
-                last_obj = dmarker
-                continue
+    if not found:
+        no_versions()
 
-            # This version needs to be restored..
-            last_obj = obj
+    wait_futures()
+    if args.wait and not wait_glacier(obj_needs_be_deleted):
+        return False
+    # delete objects which came in existence after pit_end_date only if the destination bucket is same as source bucket and restoring to same object key
+    if args.dest_bucket == args.bucket and not args.dest_prefix and not snapshots:
+        if not delete_objs(obj for obj in obj_needs_be_deleted.values() if resume is None or obj["Key"] not in resume["Deleted"]):
+            return False
+    if verify_file is not None and not verify_restore(dest_prefixes):
+        return False
+    print_summary()
+    return True
 
-            if handled_by_glacier(obj):
-                continue
+def do_apply():
+    # A plan is applied without any listing: its actions go straight to the transfer workers
+    if args.shard_bounds:
+        load_shard_bounds(args.shard_bounds)
+    start_transfers()
+    plan_file = gzip.open(args.apply, "rt")
+    glacier_state_path = os.path.abspath(args.glacier_state) if args.glacier_state else None
 
-            if args.dest_bucket is not None:
-                obj_needs_be_deleted.pop(obj["Key"], None)
-                handled_by_copy(obj)
+    if args.debug: boto3.set_stream_logger('botocore')
+
+    if args.dest_bucket is None and not args.archive and not args.dry_run:
+        if not os.path.exists(args.dest):
+            os.makedirs(args.dest)
+        os.chdir(args.dest)
+
+    if args.skip_existing and args.dest_bucket is not None:
+        list_dest_objs([args.dest_prefix])
+
+    if args.glacier_state:
+        load_glacier_state(glacier_state_path)
+
+    # Deletes come last in a plan, and wait for the transfers like in a restore
+    deletes = DeleteSet()
+    with plan_file:
+        for line in plan_file:
+            entry = json.loads(line)
+            obj = obj_from_plan(entry)
+            # A plan is split across nodes by applying it with --shard on each one
+            if not owns_key(obj["Key"]):
                 continue
+            count_listed(1)
+            if entry.get("Bucket", args.bucket) != args.bucket:
+                print("Plan %s was made for a restore of bucket %s, exiting ..." % (args.apply, entry["Bucket"]), file=sys.stderr)
+                sys.exit(1)
+            # The keys deleted by a plan are the original keys, only a restore in place may delete them
+            if obj["Action"] == "delete":
+                if args.dest_bucket != args.bucket or args.dest_prefix:
+                    print("Plan %s was made for a restore in place of %s, exiting ..." % (args.apply, args.bucket), file=sys.stderr)
+                    sys.exit(1)
+                deletes[obj["Key"]] = obj
+                continue
+            if obj["Action"] in ("copy", "download") and (obj["Action"] == "copy") != (args.dest_bucket is not None):
+                print("Plan %s was made for a restore to %s, exiting ..." % (args.apply, "a bucket" if obj["Action"] == "copy" else "a local directory"), file=sys.stderr)
+                sys.exit(1)
+            if not restore_obj(obj, None):
+                return False
+    metrics["ListingDone"] = True
 
-            if not handled_by_standard(obj):
-                return
+    wait_futures()
+    if args.wait and not wait_glacier(None):
+        return False
+    if not delete_objs(dict(obj, Action="delete") for obj in deletes.values()):
+        return False
+    if verify_file is not None and not verify_restore([args.dest_prefix]):
+        return False
+    print_summary()
+    return True
 
-        # The last dmarker may belong to the next version (if dmarker["Key"] != obj["Key"] ), keep it
-        previous_deletemarkers.append(dmarker)
-        # And all following may too, if any, so add them now.
-        while deletemarkers:
-            previous_deletemarkers.append(deletemarkers.pop(0))
+def do_restore_async():
+    # aiobotocore is only needed by the async engine
+    try:
+        from aiobotocore.session import get_session
+        from aiobotocore.config import AioConfig
+    except ImportError:
+        print("The async engine needs aiobotocore, install it with: pip install aiobotocore", file=sys.stderr)
+        sys.exit(1)
+    global asyncio
+    import asyncio
 
-        for future in concurrent.futures.as_completed(futures):
-            if future in futures:
-                try:
-                    future.result()
-                    print_obj(futures[future])
-                except Exception as ex:
-                    print('"%s" %s %s %s %s "ERROR: %s"' % (obj["LastModified"], obj["VersionId"], obj["Size"], obj["StorageClass"], obj["Key"], ex), file=sys.stderr)
-                del(futures[future])
-    # delete objects which came in existence after pit_end_date only if the destination bucket is same as source bucket and restoring to same object key
-    if args.dest_bucket == args.bucket and not args.dest_prefix:
-        for key in obj_needs_be_deleted:
-            handled_by_delete(obj_needs_be_deleted[key])
-        for future in concurrent.futures.as_completed(futures):
-            if future in futures:
-                try:
-                    future.result()
-                    print_obj(futures[future])
-                except Exception as ex:
-                    print('"%s" %s %s %s %s "ERROR: %s"' % (obj["LastModified"], obj["VersionId"], obj["Size"], obj["StorageClass"], obj["Key"], ex))
-                del(futures[future])
+    if args.shard_bounds:
+        load_shard_bounds(args.shard_bounds)
+    pit_start_date = (parse(args.from_timestamp) if args.from_timestamp else datetime.fromtimestamp(0, timezone.utc))
+    pit_end_dates = get_pit_end_dates()
 
-if __name__=='__main__':
-    signal.signal(signal.SIGINT, signal_handler)
+    if args.debug: boto3.set_stream_logger('botocore')
+
+    if args.dest_bucket is None and not args.archive and not args.dry_run:
+        if not os.path.exists(args.dest):
+            os.makedirs(args.dest)
+        os.chdir(args.dest)
+
+    async def restore():
+        global async_client, async_inflight
+        session = get_session()
+        config = AioConfig(max_pool_connections=args.max_workers)
+        async with session.create_client('s3', endpoint_url=args.endpoint_url, verify=False, config=config) as async_client:
+            async_client.meta.events.register("before-call.s3", before_request)
+            async_client.meta.events.register("after-call.s3", after_request)
+            async_client.meta.events.register("after-call-error.s3", after_request)
+            async_inflight = asyncio.Semaphore(args.max_workers)
+            return await restore_async(pit_start_date, pit_end_dates)
+
+    # Counted like the transfers of the threads engine, for the same summary
+    init_concurrency(args.max_workers, args.max_workers)
+    init_metrics()
+    found = asyncio.run(restore())
+    if found is None:
+        return False
+    if not found:
+        no_versions()
+    print_summary()
+    return True
+
+async def restore_async(pit_start_date, pit_end_dates):
+    # Listing, resolution and transfers share one event loop: the listing goes on while up to
+    # max_workers requests are in flight, and waits for a free slot otherwise
+    snapshots = len(pit_end_dates) > 1
+    pits = [new_pit(pit_end_date, snapshot_label(pit_end_date)) for pit_end_date in pit_end_dates]
+    obj_needs_be_deleted = DeleteSet() if not snapshots else None
+    found = 0
+    paginator = async_client.get_paginator('list_object_versions')
+    async for page in paginator.paginate(Bucket=args.bucket, Prefix=args.prefix):
+        if interrupted.is_set():
+            await wait_async()
+            return None
+        page = owned_page({"Versions": [compact_obj(obj) for obj in page.get("Versions", [])], "DeleteMarkers": [compact_obj(obj) for obj in page.get("DeleteMarkers", [])]})
+        for obj in resolve_page(pits, page, pit_start_date, obj_needs_be_deleted):
+            await restore_obj_async(obj, obj_needs_be_deleted)
+        found += len(page["Versions"])
+        count_listed(len(page["Versions"]))
+    if not found:
+        return 0
+
+    if not await wait_async():
+        return None
+    if args.dest_bucket == args.bucket and not args.dest_prefix and not snapshots:
+        batch = []
+        for obj in obj_needs_be_deleted.values():
+            batch.append(obj)
+            if len(batch) == DELETE_BATCH_SIZE:
+                await submit_async(s3_delete_objects_async, batch)
+                batch = []
+        if batch:
+            await submit_async(s3_delete_objects_async, batch)
+        if not await wait_async():
+            return None
+    return found
+
+async def wait_async():
+    # Waits a second at a time, a SIGINT only sets interrupted: the tasks still running are then cancelled
+    while async_tasks:
+        if interrupted.is_set():
+            for task in list(async_tasks):
+                task.cancel()
+            await asyncio.gather(*async_tasks, return_exceptions=True)
+            return False
+        await asyncio.wait(list(async_tasks), timeout=1)
+    return not interrupted.is_set()
+
+async def restore_obj_async(obj, obj_needs_be_deleted):
+    if obj["StorageClass"] in GLACIER_STORAGE_CLASSES:
+        print_obj(obj, optional_message='needs restore')
+        return
+
+    if args.dest_bucket is not None:
+        if obj_needs_be_deleted is not None:
+            keep_from_delete(obj_needs_be_deleted, obj)
+        if args.dry_run:
+            print_obj(obj)
+            return
+        await submit_async(s3_copy_object_async, obj)
+        return
+
+    if args.dry_run:
+        print_obj(obj)
+        return
+    if obj["Key"].endswith("/"):
+        for path in get_paths(obj):
+            if not os.path.exists(path):
+                os.makedirs(path)
+        return
+    make_dirs(obj)
+    await submit_async(download_file_async, obj)
+
+async def submit_async(fn, obj):
+    # Nothing is started anymore once interrupted, the listing stops at its next page
+    if interrupted.is_set():
+        return
+    await async_inflight.acquire()
+    task = asyncio.ensure_future(run_async(fn, obj))
+    async_tasks.add(task)
+    task.add_done_callback(async_tasks.discard)
+
+async def run_async(fn, obj):
+    # Never waits: the semaphore keeps the running requests under the limit
+    acquire_request()
+    start = time.monotonic()
+    try:
+        errors = await fn(obj)
+    except Exception as ex:
+        errors = ex
+    finally:
+        async_inflight.release()
+    release_request(time.monotonic() - start, isinstance(errors, Exception) and is_throttled(errors))
+    # Batches of deletes are reported key by key like in report_batch
+    for restored_obj in (obj if isinstance(obj, list) else [obj]):
+        error = errors.get(restored_obj["Key"]) if isinstance(errors, dict) else errors
+        if error is None:
+            print_obj(restored_obj)
+            # Deletes are counted with the restored objects, without any size
+            count_obj(failed=False, size=0 if isinstance(obj, list) else restored_obj.get("Size") or 0)
+        else:
+            print_error(restored_obj, error)
+            count_obj(failed=True)
+
+async def download_file_async(obj):
+    paths = get_paths(obj)
+    response = await async_client.get_object(Bucket=args.bucket, Key=obj["Key"], VersionId=obj["VersionId"])
+    async with response["Body"] as body:
+        with open(paths[0], "wb") as f:
+            async for chunk in body.iter_chunks(args.multipart_chunksize):
+                f.write(chunk)
+    unixtime = get_mtime(obj)
+    os.utime(paths[0],(unixtime, unixtime))
+    for path in paths[1:]:
+        link_file(paths[0], path)
+
+async def s3_copy_object_async(obj):
+    keys = get_keys(obj)
+    await s3_copy_async({'Bucket': args.bucket, 'Key': obj["Key"], 'VersionId': obj["VersionId"]}, keys[0], obj["Size"])
+    for key in keys[1:]:
+        await s3_copy_async({'Bucket': args.dest_bucket, 'Key': keys[0]}, key, obj["Size"])
+
+async def s3_copy_async(copy_source, key, size):
+    extra_args = { }
+
+    if args.sse is not None:
+        extra_args['ServerSideEncryption'] = args.sse
+
+    # Same split as the transfer manager of the threaded engine, so that both give the same ETags
+    if size < args.multipart_threshold:
+        await async_client.copy_object(Bucket=args.dest_bucket, Key=key, CopySource=copy_source, **extra_args)
+        return
 
+    upload = await async_client.create_multipart_upload(Bucket=args.dest_bucket, Key=key, **extra_args)
+    parts = asyncio.Semaphore(args.max_concurrency)
+
+    async def copy_part(number, start):
+        async with parts:
+            end = min(start + args.multipart_chunksize, size) - 1
+            response = await async_client.upload_part_copy(Bucket=args.dest_bucket, Key=key, CopySource=copy_source, UploadId=upload["UploadId"],
+                                                           PartNumber=number, CopySourceRange="bytes=%d-%d" % (start, end))
+            return {"PartNumber": number, "ETag": response["CopyPartResult"]["ETag"]}
+
+    try:
+        completed = await asyncio.gather(*[copy_part(number, start) for number, start in enumerate(range(0, size, args.multipart_chunksize), 1)])
+        await async_client.complete_multipart_upload(Bucket=args.dest_bucket, Key=key, UploadId=upload["UploadId"], MultipartUpload={"Parts": completed})
+    except Exception:
+        await async_client.abort_multipart_upload(Bucket=args.dest_bucket, Key=key, UploadId=upload["UploadId"])
+        raise
+
+async def s3_delete_objects_async(batch):
+    response = await async_client.delete_objects(Bucket=args.dest_bucket, Delete={'Objects': [{'Key': obj["Key"]} for obj in batch], 'Quiet': True})
+    return {error["Key"]: "%s %s" % (error["Code"], error["Message"]) for error in response.get("Errors", [])}
+
+def build_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-b', '--bucket', help='s3 bucket to restore from', required=True)
+    parser.add_argument('-b', '--bucket', help='s3 bucket to restore from')
     parser.add_argument('-B', '--dest-bucket', help='s3 bucket where recovering to', required=False)
     parser.add_argument('-d', '--dest', help='path where recovering to on local', default="")
     parser.add_argument('-p', '--prefix', help='s3 path to restore from', default="")
     parser.add_argument('-P', '--dest-prefix', help='s3 path to restore to', default="")
-    parser.add_argument('-t', '--timestamp', help='final point in time to restore at')
+    parser.add_argument('-t', '--timestamp', help='final point in time to restore at, can be repeated to restore a snapshot for each one', action='append')
+    parser.add_argument('--timestamp-step', help='restore a snapshot every TIMESTAMP_STEP seconds between the two timestamps given', type=int)
     parser.add_argument('-f', '--from-timestamp', help='starting point in time to restore from')
     parser.add_argument('-e', '--enable-glacier', help='enable recovering from glacier', action='store_true')
+    parser.add_argument('--glacier-state', help='file recording the restore status of archived versions, so that reruns only poll the pending ones')
+    parser.add_argument('--wait', help='wait for the archived versions to be restored and transfer them as soon as they are ready', action='store_true')
     parser.add_argument('-v', '--verbose', help='print verbose informations from s3 objects', action='store_true')
     parser.add_argument('-u', '--endpoint-url', help='use another endpoint URL for s3 service')
     parser.add_argument('--dry-run', help='execute query without transferring files', action='store_true')
     parser.add_argument('--debug', help='enable debug output', action='store_true')
     parser.add_argument('--test', help='s3 pit restore testing', action='store_true')
+    parser.add_argument('--benchmark', help='run the benchmarks against an in-process S3 stand-in, no bucket needed', action='store_true')
+    parser.add_argument('--benchmark-keys', help='number of keys of the synthetic bucket of the benchmarks, with about 3.5 versions each', default=300000, type=int)
+    parser.add_argument('--benchmark-baseline', help='JSON file of the benchmark results to compare with, recorded there when it doesn\'t exist')
+    parser.add_argument('--benchmark-tolerance', help='fraction by which a benchmark result can be worse than the baseline', default=0.2, type=float)
     parser.add_argument('--max-workers', help='max number of concurrent download requests', default=10, type=int)
+    parser.add_argument('--adaptive', help='adapt the number of running requests to the latency and throttling of S3, up to --max-workers', action='store_true')
+    parser.add_argument('--throttle-retries', help='max number of retries of an object throttled by S3 (SlowDown, 503)', default=5, type=int)
+    parser.add_argument('--engine', help='run the transfers on a pool of threads, or on an event loop with aiobotocore (async)', choices=['threads', 'async'], default='threads')
+    parser.add_argument('--max-concurrency', help='max number of concurrent requests of each worker for multipart transfers', default=10, type=int)
+    parser.add_argument('--multipart-threshold', help='size from which objects are transferred in parts (K, M and G suffixes are accepted)', default="8M", type=parse_size)
+    parser.add_argument('--multipart-chunksize', help='size of the parts of multipart transfers (K, M and G suffixes are accepted)', default="8M", type=parse_size)
+    parser.add_argument('--small-object-threshold', help='size under which objects are transferred with a single request, without the transfer manager (K, M and G suffixes are accepted)', default="1M", type=parse_size)
+    parser.add_argument('--max-bandwidth', help='max bandwidth of all the downloads together in bytes per second (K, M and G suffixes are accepted)', type=parse_size)
+    parser.add_argument('--listing-workers', help='number of key space shards listed in parallel', default=1, type=int)
+    parser.add_argument('--queue-size', help='max number of listed versions waiting to be transferred', default=1000, type=int)
+    parser.add_argument('--index', help='local version index file, used instead of listing the bucket once it holds the prefix')
+    parser.add_argument('--inventory', help='manifest.json of a local S3 Inventory report listing all the versions, used instead of listing the bucket')
+    parser.add_argument('--refresh-index', help='list the bucket again to refresh the version index', action='store_true')
+    parser.add_argument('--checkpoint', help='journal file recording the restore progress')
+    parser.add_argument('--skip-existing', help='skip the objects already restored at the destination (same size and mtime on local, same size and ETag on s3)', action='store_true')
+    parser.add_argument('--dedup', help='transfer once the versions with the same content (same ETag and size), and restore the others from the first one', action='store_true')
+    parser.add_argument('--archive', help='restore into a tar archive instead of a local directory, compressed by its extension (.tar.zst, .tar.gz, .tar.bz2, .tar.xz)')
+    parser.add_argument('--archive-max-size', help='split the archive in numbered parts of about this uncompressed size (K, M and G suffixes are accepted)', type=parse_size)
+    parser.add_argument('--verify', help='verify the restored objects against their version once restored, by size and ETag (etag) or by their S3 additional checksums (checksum)',
+                        nargs='?', choices=['etag', 'checksum'], const='etag')
+    parser.add_argument('--verify-out', help='write the objects failing the verification to a gzipped JSON lines plan, to be restored again with --apply')
+    parser.add_argument('--plan-out', help='write the restore plan (or the actions failed by --apply) to a gzipped JSON lines file, without transferring anything')
+    parser.add_argument('--apply', help='apply a restore plan written by --plan-out, without listing the bucket')
+    parser.add_argument('--shard', help='restore only the share INDEX of COUNT of the keys, so that COUNT nodes restore the prefix together', type=parse_shard)
+    parser.add_argument('--shard-bounds', help='file with the COUNT - 1 sorted keys splitting the prefix in the key ranges of the shards, instead of sharding by key hash')
+    parser.add_argument('--summary-out', help='write the summary of the restore to a JSON file')
+    parser.add_argument('--progress', help='print a progress line with the throughput and the ETA every PROGRESS seconds', type=int)
+    parser.add_argument('--metrics-out', help='keep the metrics of the restore (throughput, phase timings, request latencies) in a Prometheus textfile')
+    parser.add_argument('--merge-summaries', help='print the summary of the restore from the JSON summaries of its shards', nargs='+')
+    parser.add_argument('--resume', help='resume an interrupted restore from its checkpoint journal', action='store_true')
     parser.add_argument('--sse', choices=['AES256', 'aws:kms'], help='Specify server-side encryption')
-    args = parser.parse_args()
+    return parser
+
+def check_args(error):
+    if not args.bucket:
+        error("the following arguments are required: -b/--bucket")
+
+    if args.progress is not None and args.progress <= 0:
+        error("--progress needs a positive number of seconds")
+
+    # Written after the move to the destination directory, so relative paths are taken before it
+    if args.summary_out:
+        args.summary_out = os.path.abspath(args.summary_out)
+    if args.metrics_out:
+        args.metrics_out = os.path.abspath(args.metrics_out)
 
-    if args.dest_bucket is None and not args.dest:
-        parser.error("Either provide destination bucket using (-B ) or provide destination for local restore (-d)")
+    if args.shard_bounds and not args.shard:
+        error("--shard-bounds needs the shard to restore (--shard)")
+
+    if args.dest_bucket is None and not args.dest and not args.archive:
+        error("Either provide destination bucket using (-B ) or provide destination for local restore (-d) or archive (--archive)")
         sys.exit(1)
 
+    if args.archive:
+        unsupported = [option for option, value in (("-B", args.dest_bucket), ("-d", args.dest), ("-e", args.enable_glacier), ("--skip-existing", args.skip_existing),
+                                                    ("--checkpoint", args.checkpoint), ("--engine async", args.engine == "async"), ("--dedup", args.dedup),
+                                                    ("--test", args.test)) if value]
+        if unsupported:
+            error("--archive doesn't support %s" % ", ".join(unsupported))
+
+    if args.verify_out and not args.verify:
+        error("--verify-out needs the verification of the restore (--verify)")
+
+    if args.verify:
+        unsupported = [option for option, value in (("--archive", args.archive), ("--plan-out without --apply", args.plan_out and not args.apply),
+                                                    ("--dry-run", args.dry_run), ("--engine async", args.engine == "async"), ("--test", args.test)) if value]
+        if unsupported:
+            error("--verify doesn't support %s" % ", ".join(unsupported))
+
+    if args.archive_max_size and not args.archive:
+        error("--archive-max-size needs the archive to write (--archive)")
+
+    if args.timestamp_step is not None and (args.timestamp_step <= 0 or not args.timestamp or len(args.timestamp) != 2):
+        error("--timestamp-step needs a positive step and exactly two timestamps (-t)")
+
+    if args.refresh_index and not args.index:
+        error("--refresh-index needs the version index file (--index)")
+
+    if args.refresh_index and args.inventory:
+        error("--refresh-index lists the bucket again, it can't be used with --inventory")
+
+    if args.resume and not args.checkpoint:
+        error("--resume needs the checkpoint journal file (--checkpoint)")
+
+    if args.apply:
+        unsupported = [option for option, value in (("-t", args.timestamp), ("-f", args.from_timestamp), ("--index", args.index), ("--inventory", args.inventory),
+                                                    ("--checkpoint", args.checkpoint), ("--test", args.test)) if value]
+        if unsupported:
+            error("--apply doesn't support %s, the plan already holds the versions to restore" % ", ".join(unsupported))
+
+    if args.engine == "async":
+        unsupported = [option for option, value in (("--checkpoint", args.checkpoint), ("--index", args.index), ("--inventory", args.inventory), ("--skip-existing", args.skip_existing),
+                                                    ("--enable-glacier", args.enable_glacier), ("--max-bandwidth", args.max_bandwidth),
+                                                    ("--listing-workers", args.listing_workers != 1), ("--adaptive", args.adaptive), ("--dedup", args.dedup), ("--plan-out", args.plan_out),
+                                                    ("--apply", args.apply), ("--progress", args.progress), ("--metrics-out", args.metrics_out),
+                                                    ("--test", args.test)) if value]
+        if unsupported:
+            error("--engine async doesn't support %s" % ", ".join(unsupported))
+
+if __name__=='__main__':
+    signal.signal(signal.SIGINT, signal_handler)
+
+    parser = build_parser()
+    args = parser.parse_args()
+
+    if args.merge_summaries:
+        summaries = []
+        for path in args.merge_summaries:
+            with open(path) as summary_file:
+                summaries.append(json.load(summary_file))
+        print_summary(merge_summaries(summaries))
+        sys.exit(0)
+
+    if args.benchmark:
+        result = unittest.TextTestRunner().run(unittest.TestLoader().loadTestsFromTestCase(TestBenchmark))
+        sys.exit(0 if result.wasSuccessful() else 1)
+
+    check_args(parser.error)
+
+    # Warnings, like the ones of the unverified HTTPS requests, are only silenced on the command line
+    import shutup;shutup.please()
     if not args.test:
-        do_restore()
-    else:
+        run_restore()
+    if args.test:
+        import_boto3()
         runner = unittest.TextTestRunner()
+        results = []
+        for case in (TestPitResolver, TestInventory, TestShards, TestVerify, TestSkipExisting, TestResume, TestSession):
+            results.append(runner.run(unittest.TestLoader().loadTestsFromTestCase(case)))
         dest_bucket = args.dest_bucket
         dest_prefix = args.dest_prefix
 
@@ -424,17 +3436,18 @@ if __name__=='__main__':
         args.dest_prefix = None
         if args.dest:
             itersuite = unittest.TestLoader().loadTestsFromTestCase(TestS3PitRestore)
-            runner.run(itersuite)
+            results.append(runner.run(itersuite))
 
         # Restore back dest_bucket state
         args.dest_bucket = dest_bucket
         if args.dest_bucket is not None:
             itersuite = unittest.TestLoader().loadTestsFromTestCase(TestS3PitRestore)
-            runner.run(itersuite)
+            results.append(runner.run(itersuite))
 
             # Restore back dest_prefix state
             if dest_prefix:
                 args.dest_prefix = dest_prefix
                 itersuite = unittest.TestLoader().loadTestsFromTestCase(TestS3PitRestore)
-                runner.run(itersuite)
+                results.append(runner.run(itersuite))
+        sys.exit(0 if all(result.wasSuccessful() for result in results) else 1)
     sys.exit(0)
@@ -0,0 +1,12 @@
+#!/usr/bin/env python3
+#
+# Importable name of s3-pit-restore.py, for the scripts restoring many prefixes in a single process:
+#
+#     from s3_pit_restore import RestoreSession
+#
+# The script is run in this module, so both names are the same module with the same state.
+
+import importlib.util, os, sys
+
+spec = importlib.util.spec_from_file_location(__name__, os.path.join(os.path.dirname(os.path.abspath(__file__)), "s3-pit-restore.py"))
+spec.loader.exec_module(sys.modules[__name__])